@@ -2,7 +2,9 @@ import datetime
 import glob
 import json
 import os
+import queue
 import shutil
+import tempfile
 import time
 from multiprocessing import Pool
 
@@ -18,9 +20,13 @@ import covid_data_testing
 import covid_data_tweets
 import covid_data_vac
 from utils_pandas import add_data
+from utils_pandas import combine_all
 from utils_pandas import cum2daily
 from utils_pandas import export
+from utils_pandas import first_change
+from utils_pandas import from_handle
 from utils_pandas import import_csv
+from utils_pandas import to_handle
 from utils_pandas import weekly2daily
 from utils_scraping import CHECK_NEWER
 from utils_scraping import logger
@@ -28,7 +34,9 @@ from utils_scraping import USE_CACHE_DATA
 from utils_scraping import web_files
 from utils_thai import DISTRICT_RANGE
 from utils_thai import get_fuzzy_provinces
+from utils_thai import get_provinces
 from utils_thai import join_provinces
+from utils_thai import save_aliases
 from utils_thai import today
 
 
@@ -185,15 +193,77 @@ def get_hospital_resources():
 # health district 8 data - https://r8way.moph.go.th/r8way/covid-19
 
 
-def do_work(job):
+def do_work(job, share_dir=None):
     global job_data
     start = time.time()
     logger.info(f"==== {job.__name__} Start ====")
     data = job()
     logger.info(f"==== {job.__name__} in {datetime.timedelta(seconds=time.time() - start)} ====")
+    if share_dir is not None:
+        # Pass back a path rather than pickling big frames through the pool
+        data = to_handle(data, share_dir)
     return (job.__name__, data)
 
 
+def run_dag(steps, lanes):
+    """
+    Run each step as soon as the steps it depends on are done.
+
+    steps is a list of (func, deps, lane). Scrapers have no deps and are run in the Pool for their lane and stored
+    under func.__name__. Steps in the "main" lane are run in this process with the results of deps as arguments.
+    lanes is lane -> number of processes so we can control parallelism per job.
+    """
+    names = [func.__name__ for func, _, _ in steps]
+    for func, deps, _ in steps:
+        missing = set(deps) - set(names)
+        assert not missing, f"{func.__name__} depends on unknown steps {missing}"
+
+    finished = queue.Queue()  # pool callbacks come in on another thread
+    pools = {}
+    res = {}
+    pending = list(steps)
+    running = 0
+    share_dir = tempfile.TemporaryDirectory(prefix="covid_data_")
+    try:
+        while pending or running:
+            ready = [step for step in pending if all(dep in res for dep in step[1])]
+            for step in ready:
+                pending.remove(step)
+                func, deps, lane = step
+                if lane == "main":
+                    start = time.time()
+                    logger.info(f"==== {func.__name__} Start ====")
+                    res[func.__name__] = func(*[res[dep] for dep in deps])
+                    logger.info(f"==== {func.__name__} in {datetime.timedelta(seconds=time.time() - start)} ====")
+                    break  # might have made other steps ready
+                else:
+                    if lane not in pools:
+                        pools[lane] = Pool(lanes[lane])
+                    pools[lane].apply_async(do_work, (func, share_dir.name), callback=finished.put,
+                                            error_callback=finished.put)
+                    running += 1
+            else:
+                if not running:
+                    assert not pending, f"Can't run steps {[func.__name__ for func, _, _ in pending]}"
+                    break
+                result = finished.get()
+                running -= 1
+                if isinstance(result, BaseException):
+                    raise result
+                name, data = result
+                res[name] = from_handle(data)
+    except BaseException:
+        for pool in pools.values():
+            pool.terminate()
+        raise
+    finally:
+        share_dir.cleanup()
+    for pool in pools.values():
+        pool.close()
+        pool.join()
+    return res
+
+
 def scrape_and_combine():
     os.makedirs("api", exist_ok=True)
     quick = USE_CACHE_DATA and os.path.exists(os.path.join('api', 'combined.csv'))
@@ -207,126 +277,171 @@ def scrape_and_combine():
         old = import_csv("combined")
         old = old.set_index("Date")
         return old
-    jobs = [
-        # covid_data_vac.vac_slides,
-        # covid_data_vac.vaccination_reports,
-        # covid_data_briefing.get_cases_by_prov_briefings,
-        covid_data_dash.dash_weekly,
-        covid_data_dash.dash_province_weekly,
-        covid_data_dash.dash_by_province,
-        covid_data_api.get_cases_by_demographics_api,
-        covid_data_dash.dash_ages,
-        # covid_data_situation.get_thai_situation,
-        # covid_data_situation.get_en_situation,
-        covid_data_testing.get_test_reports,
-        covid_data_dash.dash_daily,
-        covid_data_api.excess_deaths,
-        covid_data_testing.get_tests_by_day,
-        covid_data_testing.get_tests_per_province,
-        # covid_data_tweets.get_cases_by_prov_tweets,
-        covid_data_api.get_cases_timelineapi,
-        covid_data_api.get_cases_timelineapi_weekly,
-        covid_data_testing.get_variant_reports,
-        covid_data_api.ihme_dataset,
-        covid_data_api.timeline_by_province,
-        covid_data_api.timeline_by_province_weekly,
-        covid_data_api.deaths_by_province_weekly,
-        # This doesn't add any more info since severe cases was a mistake
-        # covid_data_dash.dash_trends_prov
-        # covid_data_bed.get_df
-        # covid_data_situation.get_situation_today
-    ]
 
-    with Pool(1 if MAX_DAYS > 0 else None) as pool:
-        res = dict(pool.imap_unordered(do_work, jobs))
-        pool.close()
-        pool.join()
-    logger.info(f"data={len(res)}")
+    vaccols = [f"Vac Given {d} Cum" for d in range(1, 5)]
 
-    # vac_reports, vac_reports_prov = res['vaccination_reports']
-    # briefings_prov, cases_briefings = res['get_cases_by_prov_briefings']
-    cases_demo, risks_prov, case_api_by_area = res['get_cases_by_demographics_api']
-    # tweets_prov, twcases = res['get_cases_by_prov_tweets']
+    def hospcols(dash_province_weekly):
+        return [c for c in dash_province_weekly.columns if 'Hospitalized' in c]
+
+    def dfprov(timeline_by_province, timeline_by_province_weekly, deaths_by_province_weekly, dash_by_province,
+               dash_province_weekly, get_cases_by_demographics_api):
+        _, risks_prov, _ = get_cases_by_demographics_api
+        _, deaths_prov_weekly = deaths_by_province_weekly
+        # tweets_prov, twcases = res['get_cases_by_prov_tweets']
+
+        # Combine dashboard data
+        # dash_by_province = dash_trends_prov.combine_first(dash_by_province)
+        #export(res['dash_by_province'], "moph_dashboard_prov", csv_only=True, dir="inputs/json")
+
+        # Export per province
+        briefings_prov = import_csv("cases_briefings_prov", ["Date", "Province"], False)
+        # export(briefings_prov, "cases_briefings_prov", csv_only=True)
+        # TODO; put tweets_prov into cases_briefings_prov
+        # only the last few weeks of the dashboard change so reuse last runs daily values before that
+        prov_weekly_daily = import_csv("dash_prov_weekly_daily", ["Date", "Province"], dir="inputs/json")
+        prov_weekly_daily = cum2daily(dash_province_weekly, drop=False, exclude=vaccols + hospcols(dash_province_weekly),
+                                      previous=prov_weekly_daily)
+        export(prov_weekly_daily, "dash_prov_weekly_daily", csv_only=True, dir="inputs/json")
+        dfprov = import_csv("cases_by_province", ["Date", "Province"], not USE_CACHE_DATA)
+        dfprov = combine_all([
+            dfprov,
+            briefings_prov,
+            timeline_by_province,
+            timeline_by_province_weekly,
+            deaths_prov_weekly,
+            dash_by_province,
+            prov_weekly_daily,
+            # tweets_prov,
+            risks_prov,  # TODO: check they agree
+        ])
+        dfprov = join_provinces(dfprov, on="Province")
+        if "Hospitalized Severe" in dfprov.columns:
+            # Made a mistake. This is really Cases Proactive
+            dfprov["Cases Proactve"] = dfprov["Hospitalized Severe"]
+            dfprov = dfprov.drop(columns=["Hospitalized Severe"])
+        export(dfprov, "cases_by_province")
+        return dfprov
+
+    def cases_by_area(dfprov, get_cases_by_demographics_api):
+        _, _, case_api_by_area = get_cases_by_demographics_api
+        # Export per district (except tests which are dodgy?)
+        by_area = prov_to_districts(dfprov[[c for c in dfprov.columns if "Tests" not in c]])
+
+        cases_by_area = import_csv("cases_by_area", ["Date"], not USE_CACHE_DATA)
+        cases_by_area = cases_by_area.combine_first(by_area).combine_first(case_api_by_area)
+        export(cases_by_area, "cases_by_area")
+        return cases_by_area
+
+    def ihme(ihme_dataset):
+        # Export IHME dataset
+        export(ihme_dataset, "ihme")
+
+    def dash_weekly_daily(dash_weekly, dash_province_weekly):
+        dash_weekly = cum2daily(dash_weekly, drop=False, exclude=vaccols + hospcols(dash_province_weekly))
+        # only the last few weeks change so reuse last runs daily deaths from before the weekly values changed
+        weekly = dash_weekly[[c for c in dash_weekly.columns if "Deaths " in c]]
+        old_weekly = import_csv("dash_weekly_deaths", ["Date"], dir="inputs/json")
+        previous = import_csv("dash_weekly_deaths_daily", ["Date"], dir="inputs/json")
+        since = first_change(old_weekly, weekly) if not old_weekly.empty else None
+        if not old_weekly.empty and since is None:
+            since = weekly.index.max() + datetime.timedelta(days=1)
+        daily = weekly2daily(weekly, previous=previous, since=since)
+        export(weekly, "dash_weekly_deaths", csv_only=True, dir="inputs/json")
+        export(daily, "dash_weekly_deaths_daily", csv_only=True, dir="inputs/json")
+        return dash_weekly.combine_first(daily)
+
+    def combined(get_test_reports, get_tests_by_day, get_cases_timelineapi, get_cases_timelineapi_weekly,
+                 deaths_by_province_weekly, get_cases_by_demographics_api, cases_by_area, dash_ages, dash_daily,
+                 dash_weekly_daily):
+        # vac_reports, vac_reports_prov = res['vaccination_reports']
+        # briefings_prov, cases_briefings = res['get_cases_by_prov_briefings']
+        cases_demo, _, _ = get_cases_by_demographics_api
+        deaths_weekly, _ = deaths_by_province_weekly
+
+        # Export briefings
+        briefings = import_csv("cases_briefings", ["Date"], False)
+        # briefings = briefings.combine_first(cases_briefings).combine_first(twcases)
+        # export(briefings, "cases_briefings")
+
+        # Export situation
+        situation = covid_data_situation.export_situation(None, None)  # get_thai_situation, get_en_situation not run
+
+        # vac = covid_data_vac.export_vaccinations(vac_reports, vac_reports_prov, res['vac_slides'])
+        vac = import_csv("vac_timeline", ['Date'])
+
+        logger.info("========Combine all data sources==========")
+        df = combine_all([
+            pd.DataFrame(columns=["Date"]).set_index("Date"),
+            get_test_reports,
+            get_tests_by_day,
+            briefings,
+            get_cases_timelineapi,
+            get_cases_timelineapi_weekly,
+            deaths_weekly,
+            # twcases,
+            cases_demo,
+            cases_by_area,
+            situation,
+            dash_ages,
+            dash_daily,
+            dash_weekly_daily,
+            vac,
+        ])
+        logger.info(df)
+        return df
 
-    deaths_weekly, deaths_prov_weekly = res['deaths_by_province_weekly']
+    # Dashboards are slow so keep them seperate from the apis so one doesn't hold up the other
+    web = "web" if MAX_DAYS == 0 else "serial"
+    dash = "dash" if MAX_DAYS == 0 else "serial"
+    lanes = dict(web=None, dash=3, serial=1)
+    steps = [
+        # (covid_data_vac.vac_slides, [], web),
+        # (covid_data_vac.vaccination_reports, [], web),
+        # (covid_data_briefing.get_cases_by_prov_briefings, [], web),
+        (covid_data_dash.dash_weekly, [], dash),
+        (covid_data_dash.dash_province_weekly, [], dash),
+        (covid_data_dash.dash_by_province, [], dash),
+        (covid_data_api.get_cases_by_demographics_api, [], web),
+        (covid_data_dash.dash_ages, [], dash),
+        # (covid_data_situation.get_thai_situation, [], web),
+        # (covid_data_situation.get_en_situation, [], web),
+        (covid_data_testing.get_test_reports, [], web),
+        (covid_data_dash.dash_daily, [], dash),
+        (covid_data_api.excess_deaths, [], web),
+        (covid_data_testing.get_tests_by_day, [], web),
+        (covid_data_testing.get_tests_per_province, [], web),
+        # (covid_data_tweets.get_cases_by_prov_tweets, [], web),
+        (covid_data_api.get_cases_timelineapi, [], web),
+        (covid_data_api.get_cases_timelineapi_weekly, [], web),
+        (covid_data_testing.get_variant_reports, [], web),
+        (covid_data_api.ihme_dataset, [], web),
+        (covid_data_api.timeline_by_province, [], web),
+        (covid_data_api.timeline_by_province_weekly, [], web),
+        (covid_data_api.deaths_by_province_weekly, [], web),
+        # This doesn't add any more info since severe cases was a mistake
+        # (covid_data_dash.dash_trends_prov, [], dash),
+        # (covid_data_bed.get_df, [], dash),
+        # (covid_data_situation.get_situation_today, [], web),
+
+        # Combine steps. Run here as soon as the data they need is ready
+        (dfprov, ["timeline_by_province", "timeline_by_province_weekly", "deaths_by_province_weekly",
+                  "dash_by_province", "dash_province_weekly", "get_cases_by_demographics_api"], "main"),
+        (cases_by_area, ["dfprov", "get_cases_by_demographics_api"], "main"),
+        (ihme, ["ihme_dataset"], "main"),
+        (dash_weekly_daily, ["dash_weekly", "dash_province_weekly"], "main"),
+        (combined, ["get_test_reports", "get_tests_by_day", "get_cases_timelineapi", "get_cases_timelineapi_weekly",
+                    "deaths_by_province_weekly", "get_cases_by_demographics_api", "cases_by_area", "dash_ages",
+                    "dash_daily", "dash_weekly_daily"], "main"),
+    ]
+    get_provinces()  # load the province index once here so the forked workers share it
+    res = run_dag(steps, lanes)
+    logger.info(f"data={len(res)}")
 
-    # Combine dashboard data
-    # dash_by_province = dash_trends_prov.combine_first(dash_by_province)
-    #export(res['dash_by_province'], "moph_dashboard_prov", csv_only=True, dir="inputs/json")
     # "json" for caching, api so it's downloadable
     for file in glob.glob('inputs/json/moph*.csv'):
         shutil.copy(file, "api")
 
-    # Export briefings
-    briefings = import_csv("cases_briefings", ["Date"], False)
-    # briefings = briefings.combine_first(cases_briefings).combine_first(twcases)
-    # export(briefings, "cases_briefings")
-
-    vaccols = [f"Vac Given {d} Cum" for d in range(1, 5)]
-    hospcols = [c for c in res['dash_province_weekly'].columns if 'Hospitalized' in c]
-
-    # Export per province
-    briefings_prov = import_csv("cases_briefings_prov", ["Date", "Province"], False)
-    # export(briefings_prov, "cases_briefings_prov", csv_only=True)
-    # TODO; put tweets_prov into cases_briefings_prov
-    dfprov = import_csv("cases_by_province", ["Date", "Province"], not USE_CACHE_DATA)
-    dfprov = dfprov.combine_first(
-        briefings_prov).combine_first(
-        res['timeline_by_province']).combine_first(
-        res['timeline_by_province_weekly']).combine_first(
-        deaths_prov_weekly).combine_first(
-        res['dash_by_province']).combine_first(
-        cum2daily(res['dash_province_weekly'], drop=False, exclude=vaccols + hospcols)).combine_first(
-        # tweets_prov).combine_first(
-        risks_prov)  # TODO: check they agree
-    dfprov = join_provinces(dfprov, on="Province")
-    if "Hospitalized Severe" in dfprov.columns:
-        # Made a mistake. This is really Cases Proactive
-        dfprov["Cases Proactve"] = dfprov["Hospitalized Severe"]
-        dfprov = dfprov.drop(columns=["Hospitalized Severe"])
-    export(dfprov, "cases_by_province")
-
-    # Export per district (except tests which are dodgy?)
-    by_area = prov_to_districts(dfprov[[c for c in dfprov.columns if "Tests" not in c]])
-
-    cases_by_area = import_csv("cases_by_area", ["Date"], not USE_CACHE_DATA)
-    cases_by_area = cases_by_area.combine_first(by_area).combine_first(case_api_by_area)
-    export(cases_by_area, "cases_by_area")
-
-    # Export IHME dataset
-    export(res['ihme_dataset'], "ihme")
-
-    # Export situation
-    situation = covid_data_situation.export_situation(res.get('get_thai_situation', None), res.get('get_en_situation', None))
-
-    # vac = covid_data_vac.export_vaccinations(vac_reports, vac_reports_prov, res['vac_slides'])
-    vac = import_csv("vac_timeline", ['Date'])
-
-    dash_weekly = cum2daily(res['dash_weekly'], drop=False, exclude=vaccols + hospcols)
-    dash_weekly = dash_weekly.combine_first(weekly2daily(
-        dash_weekly[(c for c in dash_weekly.columns if "Deaths " in c)]))
-
-    logger.info("========Combine all data sources==========")
-    df = pd.DataFrame(columns=["Date"]).set_index("Date")
-    for f in [
-        res['get_test_reports'],
-        res['get_tests_by_day'],
-        briefings,
-        res['get_cases_timelineapi'],
-        res['get_cases_timelineapi_weekly'],
-        deaths_weekly,
-        # twcases,
-        cases_demo,
-        cases_by_area,
-        situation,
-        res['dash_ages'],
-        res['dash_daily'],
-        dash_weekly,
-        vac,
-    ]:
-        df = df.combine_first(f)
-    logger.info(df)
-
+    df = res['combined']
     if quick:
         old = import_csv("combined", index=["Date"])
         df = df.combine_first(old)
@@ -334,6 +449,7 @@ def scrape_and_combine():
     else:
         export(df, "combined", csv_only=True)
         export(get_fuzzy_provinces(), "fuzzy_provinces", csv_only=True)
+        save_aliases()
         return df
 
 
@@ -15,8 +15,10 @@ from utils_pandas import add_data
 from utils_pandas import cum2daily
 from utils_pandas import cut_ages
 from utils_pandas import export
+from utils_pandas import export_partitioned
 from utils_pandas import fuzzy_join
 from utils_pandas import import_csv
+from utils_pandas import import_partitioned
 from utils_pandas import weekly2daily
 from utils_pandas import weeks_to_end_date
 from utils_scraping import any_in
@@ -71,8 +73,8 @@ def get_cases_timelineapi():
     url1 = "https://covid19.ddc.moph.go.th/api/Cases/round-1to2-all"
     url2 = "https://covid19.ddc.moph.go.th/api/Cases/timeline-cases-all"
     try:
-        json1, _, url = next(web_files(url1, dir="inputs/json", check=False), None)
-        json2, _, url = next(web_files(url2, dir="inputs/json", check=False), None)
+        json1, _, url = next(web_files(url1, dir="inputs/json", check=False, lazy=True), None)
+        json2, _, url = next(web_files(url2, dir="inputs/json", check=False, lazy=True), None)
     except requests.exceptions.RequestException:
         # I think we have all this data covered by other sources. It's a little unreliable.
         return pd.DataFrame()
@@ -421,7 +423,7 @@ def get_case_details_api_weekly():
     # df3 = load_paged_json("https://covid19.ddc.moph.go.th/api/Deaths/round-3-line-list", ["year", "weeknum"], target_date, dir="inputs/json/weekly")
     # df1 = load_paged_json("https://covid19.ddc.moph.go.th/api/Cases/round-1to2-line-lists", ["year", "weeknum"], target_date, dir="inputs/json/weekly")
     df = load_paged_json("https://covid19.ddc.moph.go.th/api/Cases/round-4-line-lists",
-                         ["year", "weeknum"], None, dir="inputs/json/weekly/cases", timeout=40)
+                         ["year", "weeknum"], None, dir="inputs/json/weekly/cases", timeout=40, threads=4, max_pages=None)
 
     df = pd.concat([df, cases2023])
 
@@ -440,18 +442,28 @@ def get_case_details_api_weekly():
 
 def get_case_details_api():
 
-    cases = import_csv("covid-19", dir="inputs/json",
-                       date_cols=["Date", "update_date", "txn_date", "update_date2"],
-                       str_cols=["Health District Number", "Job Type", "Nat Main", "Patient Type", "age_range", "gender",
-                                 "nationality", "patient_type", "patient_type2", "risk", "risk_group", "translation", "job"],
-                       # int_cols=["No.", ] # "age", "index", "int", ]
-                       )
+    csv = "inputs/json/covid-19.csv"
+    manifest = "inputs/json/covid-19/manifest.json"
+    if os.path.exists(csv) and (not os.path.exists(manifest) or os.path.getmtime(csv) > os.path.getmtime(manifest)):
+        # Not converted yet or the csv was updated
+        cases = import_csv("covid-19", dir="inputs/json",
+                           date_cols=["Date", "update_date", "txn_date", "update_date2"],
+                           str_cols=["Health District Number", "Job Type", "Nat Main", "Patient Type", "age_range", "gender",
+                                     "nationality", "patient_type", "patient_type2", "risk", "risk_group", "translation",
+                                     "job"],
+                           # int_cols=["No.", ] # "age", "index", "int", ]
+                           )
+        if not cases.empty:
+            # only the weeks that changed get written
+            export_partitioned(cases, "covid-19", dir="inputs/json")
+    else:
+        cases = import_partitioned("covid-19", dir="inputs/json")
     return cases  # after 2022-10-01 switched same url to have weekly numbers
     # if "risk_group" not in cases.columns or cases["risk_group"].count() < 40000:
     #     cases = cleanup_cases(cases)
     if not cases.empty and cases["Date"].min() > d("2020-02-01"):
         url = "https://covid19.ddc.moph.go.th/api/Cases/round-1to2-line-lists"
-        file, _, _ = next(iter(web_files(url, dir="inputs/json", check=False, appending=False)))
+        file, _, _ = next(iter(web_files(url, dir="inputs/json", check=False, appending=False, lazy=True)))
         init_cases = pd.read_csv(file).reset_index()
         init_cases.columns = ['Date', "No.", "gender", "age", "age_range", "nationality", "job",
                               "risk", "patient_type", "province_of_onset", "update_date", "update_date2", "patient_type2"]
@@ -495,7 +507,14 @@ def get_case_details_api():
     return cases
 
 
-def load_paged_json(url, index=["year", "weeknum"], target_index=None, dir="inputs/json/weekly", check=True, proxy=False, timeout=80):
+def load_paged_json(url, index=["year", "weeknum"], target_index=None, dir="inputs/json/weekly", check=True, proxy=False,
+                    timeout=80, threads=1, max_pages=100):
+    """
+    Get all pages of a paged json api, joining onto what we cached last time.
+
+    threads > 1 fetches that many pages at a time but they are still processed in order.
+    When going forward stop after max_pages (None for no limit) so we don't take too long.
+    """
     basename = url2filename(url)
     if not target_index:
         # Then we will cache it ourselves and return the data
@@ -547,7 +566,16 @@ def load_paged_json(url, index=["year", "weeknum"], target_index=None, dir="inpu
     pages_got = 0
     is_first = False
     urls = [f"{url}?page={p}" for p in pages]
-    for file, content, _ in web_files(*urls, dir=None, check=check, appending=False, timeout=timeout, proxy=proxy, threads=1):
+
+    def fetch_pages(urls):
+        if threads <= 1:
+            yield from web_files(*urls, dir=None, check=check, appending=False, timeout=timeout, proxy=proxy, threads=1)
+            return
+        # Only a window of pages at a time. Going backwards we usually only need a few
+        for i in range(0, len(urls), threads):
+            yield from web_files(*urls[i:i + threads], dir=None, check=check, appending=False, timeout=timeout, proxy=proxy,
+                                 threads=threads)
+    for file, content, _ in fetch_pages(urls):
         if file is None:
             if backwards:
                 df = pd.DataFrame()  # Can't join it. have eto give up
@@ -584,7 +612,7 @@ def load_paged_json(url, index=["year", "weeknum"], target_index=None, dir="inpu
                 df = pd.concat([cached, df])
                 assert len(df) == total
                 break
-        elif not backwards and pages_got == 100:
+        elif not backwards and max_pages is not None and pages_got >= max_pages:
             # Cut our loses here so we don't take so much time. Get more later
             break
         pagenum += -1 if backwards else +1
@@ -649,7 +677,7 @@ def get_cases_by_demographics_api():
 
 def timeline_by_province():
     url = "https://covid19.ddc.moph.go.th/api/Cases/timeline-cases-by-provinces"
-    file, _, _ = next(iter(web_files(url, dir="inputs/json", check=False, appending=False, timeout=40)), None)
+    file, _, _ = next(iter(web_files(url, dir="inputs/json", check=False, appending=False, timeout=40, lazy=True)), None)
     df = pd.read_json(file)
     df = df.rename(columns={"txn_date": "Date", "province": "Province", "new_case": "Cases", "total_case": "Cases Cum",
                    "new_case_excludeabroad": "Cases Local", "total_case_excludeabroad": "Case Local Cum", "new_death": "Deaths", "total_death": "Deaths Cum"})
@@ -665,7 +693,7 @@ def timeline_by_province_weekly():
     # df = load_paged_json(url, ["year", "weeknum"], [2020, 1])
     dir = "inputs/json/weekly"
     url = "https://covid19.ddc.moph.go.th/api/Cases/timeline-cases-by-provinces"
-    file, _, _ = next(iter(web_files(url, dir=dir, check=False, appending=False, timeout=80)), None)
+    file, _, _ = next(iter(web_files(url, dir=dir, check=False, appending=False, timeout=80, lazy=True)), None)
     if file is None:
         logger.warning("{} missing", url)
         df = pd.DataFrame()
@@ -674,7 +702,7 @@ def timeline_by_province_weekly():
 
     url = "https://covid19.ddc.moph.go.th/api/Cases/today-cases-by-provinces"
     prefix = "today-cases-by-provinces"
-    file, _, _ = next(iter(web_files(url, dir=dir, check=True, appending=False, timeout=80, proxy=USE_PROXY)), None)
+    file, _, _ = next(iter(web_files(url, dir=dir, check=True, appending=False, timeout=80, proxy=USE_PROXY, lazy=True)), None)
 
     def week_file(week):
         return f"{dir}/{prefix}-{week}"
@@ -866,7 +894,7 @@ def ihme_dataset(check=True):
     # IHME seems to have problem with their latest section and have pointed main site back to archives
     scenario = "file_best_masks"  # "file_reference" doesn't seem to fit mask use here. they assume its dropped
     urls = [u for u in web_links("https://www.healthdata.org/covid/data-downloads", ext="csv", check=False) if scenario in u]
-    for file, _, _ in web_files(*reversed(urls), dir="inputs/IHME", check=False, appending=False):
+    for file, _, _ in web_files(*reversed(urls), dir="inputs/IHME", check=False, appending=False, lazy=True):
         data_in_file = pd.read_csv(file)
         data_in_file = data_in_file.loc[(data_in_file['location_name'] == "Thailand")]
         data = add_data(data, data_in_file)
@@ -885,7 +913,7 @@ def ihme_dataset(check=True):
 def get_ifr():
     # replace with https://stat.bora.dopa.go.th/new_stat/webPage/statByAgeMonth.php
     url = "http://statbbi.nso.go.th/staticreport/Page/sector/EN/report/sector_01_11101_EN_.xlsx"
-    file, _, _ = next(web_files(url, dir="inputs/json", check=False), None)
+    file, _, _ = next(web_files(url, dir="inputs/json", check=False, lazy=True), None)
     pop = pd.read_excel(file, header=3, index_col=1)
 
     def year_cols(start, end):
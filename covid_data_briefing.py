@@ -22,7 +22,7 @@ from utils_scraping import logger
 from utils_scraping import MAX_DAYS
 from utils_scraping import NUM_OR_DASH
 from utils_scraping import pairwise
-from utils_scraping import parse_file
+from utils_scraping import parse_files
 from utils_scraping import parse_numbers
 from utils_scraping import seperate
 from utils_scraping import split
@@ -799,7 +799,7 @@ def briefing_documents(check=False):
 
         def get_file(link=link):
             try:
-                file, text, url = next(iter(web_files(link, dir="inputs/briefings", check=check)))
+                file, text, url = next(iter(web_files(link, dir="inputs/briefings", check=check, lazy=True)))
             except StopIteration:
                 return None
             return file
@@ -816,15 +816,19 @@ def get_cases_by_prov_briefings():
     # deaths = import_csv("deaths", ["Date", "Province"], not USE_CACHE_DATA)
     deaths = pd.DataFrame(columns=["Date", "Province"]).set_index(['Date', 'Province'])
     vac_prov = pd.DataFrame(columns=["Date", "Province"]).set_index(['Date', 'Province'])
-    for briefing_url, date, get_file in briefing_documents(check=True):
+
+    def dl_file(item):
+        _, date, get_file = item
         file = get_file()
-        if file is None:
-            continue
         if date in [d("2022-04-24")]:
             # 2022-04-24: some kind of weird encoding.
             # see - https://stackoverflow.com/questions/67551128/tika-compute-content-encoding-of-a-document
+            return None
+        return file
+
+    for (briefing_url, date, _), file, pages in parse_files(briefing_documents(check=True), dl_file, html=True, paged=True):
+        if file is None:
             continue
-        pages = parse_file(file, html=True, paged=True)
         pages = [BeautifulSoup(page, 'html.parser') for page in pages]
 
         today_types = briefing_case_types(date, pages, briefing_url)
@@ -1,4 +1,5 @@
 import datetime
+import random
 import sys
 import time
 from lib2to3.pgen2.pgen import DFAState
@@ -23,10 +24,12 @@ from utils_scraping import logger
 from utils_scraping import USE_CACHE_DATA
 from utils_scraping import web_files
 from utils_scraping_tableau import force_setParameter
+from utils_scraping_tableau import tableau_published
 from utils_scraping_tableau import workbook_explore
 from utils_scraping_tableau import workbook_iterate
 from utils_scraping_tableau import workbook_series
 from utils_scraping_tableau import workbook_value
+from utils_scraping_tableau import workbook_values
 from utils_thai import get_province
 from utils_thai import today
 
@@ -43,28 +46,99 @@ from utils_thai import today
 # url = "https://ddc.moph.go.th/covid19-dashboard/index.php?dashboard=30-days"
 
 
-def todays_data():
+# Date and time todays_data first saw each day's update. Not moph* so it isn't copied to api
+DASH_READY = "dash_ready"
+DASH_POLL_SECS = 60
+DASH_FULL_CHECK_SECS = 15 * 60  # publish time might not change for a data refresh so load it anyway this often
+
+
+def usual_ready_time(history, days=30):
+    """
+    Today at the median time of day the dashboard was ready over the last days, or None if there isn't any history
+
+    >>> history = pd.DataFrame({"Ready": ["2022-01-01 10:00", "2022-01-02 11:00", "2022-01-03 10:30"]})
+    >>> usual_ready_time(history).time()
+    datetime.time(10, 30)
+    """
+    if history.empty:
+        return None
+    ready = pd.to_datetime(history["Ready"].iloc[-days:])
+    secs = (ready - ready.dt.normalize()).dt.total_seconds().median()
+    return datetime.datetime.combine(today().date(), datetime.time()) + datetime.timedelta(seconds=secs)
+
+
+def backoff(errors, base=DASH_POLL_SECS, cap=30 * 60):
+    "Secs to wait after errors in a row. Doubles each time with jitter so retries don't bunch up, but never over cap"
+    return min(cap, base * 2 ** (errors - 1) * random.uniform(0.5, 1.5))
+
+
+def dash_has_today(url):
+    "Load the whole workbook and check it says it was updated today"
+    ts = tableauscraper.TableauScraper(verify=False)
+    ts.loads(url)
+    wb = ts.getWorkbook()
+    last_update = wb.getWorksheet("D_UpdateTime (2)").data
+    if last_update.empty:
+        raise ValueError("D_UpdateTime missing")
+    last_update = pd.to_datetime(last_update['max_update_date-alias'], dayfirst=False).iloc[0]
+    return last_update.date() >= today().date()
+
+
+def todays_data(timeout=None):
+    """
+    Wait for today's update of the daily dashboard. True once it's there or False if not within timeout secs.
+
+    If another run already saw today's update in DASH_READY it returns straight away. Otherwise it checks once and
+    if it's not there yet sleeps until just before the time it was usually ready on past days. Until that time it
+    checks the cheap published time on the page and only loads the whole workbook when that changes. After it, or
+    with no history, it loads the workbook every DASH_POLL_SECS. Errors back off but never past the usual time and
+    never more than DASH_POLL_SECS after it.
+    """
     url = "https://public.tableau.com/views/SATCOVIDDashboard/1-dash-tiles"
+    history = import_csv(DASH_READY, ["Date"], False, dir="inputs/json")
+    if pd.Timestamp(today().date()) in history.index:
+        return True
+    deadline = None if timeout is None else time.time() + timeout
+
+    def wait(secs):
+        if deadline is not None:
+            secs = min(secs, deadline - time.time())
+        time.sleep(max(secs, 0))
+        return deadline is None or time.time() < deadline
+
+    expected = usual_ready_time(history)
+    errors = 0
+    slept = False
+    published = last_full = None
     # new day starts with new info comes in
     while True:
-        # dates = reversed(pd.date_range("2021-01-24", today() - relativedelta(hours=7.5)).to_pydatetime())
-        # get_wb, date = next(workbook_iterate(url, param_date=dates))
-        # date = next(iter(date))
-        # if (wb := get_wb()) is None:
-        #     continue
-        ts = tableauscraper.TableauScraper(verify=False)
-        ts.loads(url)
-        wb = ts.getWorkbook()
-
-        last_update = wb.getWorksheet("D_UpdateTime (2)").data
-        if last_update.empty:
-            continue
-        last_update = pd.to_datetime(last_update['max_update_date-alias'], dayfirst=False).iloc[0]
-        if last_update >= today().date():
-            return True
-        # We got todays data too early
-        print("z", end="")
-        time.sleep(60)
+        late = expected is None or today() >= expected
+        try:
+            now_published = None if late else tableau_published(url, verify=False)
+            if late or now_published is None or now_published != published or time.time() - last_full > DASH_FULL_CHECK_SECS:
+                published, last_full = now_published, time.time()
+                if dash_has_today(url):
+                    # only the first time we see it each day or the usual time drifts later
+                    first_seen = pd.DataFrame({"Ready": [str(today().replace(microsecond=0))]},
+                                              index=pd.DatetimeIndex([today().date()], name="Date"))
+                    export(first_seen.combine_first(history), DASH_READY, csv_only=True, dir="inputs/json")
+                    return True
+            errors = 0
+        except Exception as err:
+            errors += 1
+            logger.warning("{} MOPH Dashboard: Error checking for update: {}", today().date(), err)
+        if not slept and not late and (early := (expected - relativedelta(minutes=10) - today()).total_seconds()) > 0:
+            # not there yet so wait till just before it's usually ready. Only the first time
+            logger.info("{} MOPH Dashboard: usually ready at {}. Waiting", today().date(), expected.time())
+            secs = early
+        else:
+            # We got todays data too early
+            print("z", end="")
+            cap = DASH_POLL_SECS if late else max(DASH_POLL_SECS, (expected - today()).total_seconds())
+            secs = backoff(errors, cap=cap) if errors else DASH_POLL_SECS
+        slept = True
+        if not wait(secs):
+            return False
 
 
 def dash_daily():
@@ -242,18 +316,16 @@ def dash_weekly(file="moph_dash_weekly"):
 
     # latest = next(dates, None)
     # logger.info("{} MOPH Dashboard: checking", latest)
-    for get_wb, this_index in workbook_iterate(url, inc_no_param=False, param_date_weekend=list(dates), param_wave=["ตั้งแต่เริ่มระบาด"]):
+    def have(idx_value):
+        return skip_valid(df, idx_value[0], allow_na)
+
+    for get_wb, this_index in workbook_iterate(url, inc_no_param=False, param_date_weekend=list(dates),
+                                               param_wave=["ตั้งแต่เริ่มระบาด"], skip=have):
         # date, wave = this_index
         date = this_index[0]
         # logger.info("{} MOPH Dashboard: trying {}", date, this_index)
         # date = date if date is not None else latest
-        if skip_valid(df, date, allow_na):
-            # print("s", end="")
-            row = str(dict(df.loc[date]))
-            logger.info("{} MOPH Dashboard: skipping {}", date, row)
-            continue
-        else:
-            logger.info("{} MOPH Dashboard: reading workbook for {}", date, this_index)
+        logger.info("{} MOPH Dashboard: reading workbook for {}", date, this_index)
         if (wb := get_wb()) is None:
             logger.warning("{} MOPH Dashboard: workbook is None", date)
             continue
@@ -333,7 +405,16 @@ def dash_province_weekly(file="moph_province_weekly"):
     # soup = parse_file(file, html=True, paged=False)
     provs = [p.get("value") for p in soup.select("#sel-province")[0].find_all("option") if p.get("value")]
 
-    for get_wb, idx_value in workbook_iterate(url, inc_no_param=False, param_date_weekend=list(dates), param_wave=["ตั้งแต่เริ่มระบาด"], filters=dict(province=provs), verify=False):
+    def have(idx_value):
+        date, wave, province = idx_value
+        if province is None:
+            return True
+        province = get_province(province)
+        return skip_valid(df, (date, province), valid) and (date, province) not in decreased.index
+
+    for get_wb, idx_value in workbook_iterate(url, inc_no_param=False, param_date_weekend=list(dates),
+                                              param_wave=["ตั้งแต่เริ่มระบาด"], filters=dict(province=provs), verify=False,
+                                              skip=have):
         # for get_wb, idx_value in workbook_iterate(url, inc_no_param=False, param_date=list(dates), D2_Province="province", verify=False):
         date, wave, province = idx_value
         # if date is None:
@@ -343,9 +424,6 @@ def dash_province_weekly(file="moph_province_weekly"):
             continue
         province = get_province(province)
         # TODO: make invalid not inc Cum values
-        if skip_valid(df, (date, province), valid) and (date, province) not in decreased.index:
-            print("s", end="")
-            continue
         if (wb := get_wb()) is None:
             continue
         "D2_Update (2)"
@@ -459,17 +537,16 @@ def extract_basics(wb, date, check_date=True, base_df=None):
     if check_date and ((not deaths.empty and date < deaths.index.max()) or (not cases.empty and date < cases.index.max())):
         return row
     # date = cases.index.max()  # We can't get update date always so use lastest cases date
-    cases_cum = workbook_value(wb, date, ["D_NewACM (2)", "D2_NewACM (2)"], "Cases Cum", default=np.nan)
-    deaths_cum = workbook_value(wb, date, ["D_DeathACM (2)", "D2_DeathACM (2)"], "Deaths Cum", default=np.nan)
-    row = row.combine_first(cases_cum)
+    row = row.combine_first(workbook_values(wb, date, {
+        "Cases Cum": ["D_NewACM (2)", "D2_NewACM (2)"],
+        "Deaths Cum": ["D_DeathACM (2)", "D2_DeathACM (2)"],
+        "Hospitalized Severe": "D_Severe (2)",
+        "Hospitalized Respirator": "D_SevereTube (2)",
+    }, defaults={"Cases Cum": np.nan, "Deaths Cum": np.nan, "": None}))
     row = row.combine_first(to_cum(row, cases, "Cases")).combine_first(cases)
-    row = row.combine_first(deaths_cum)
     if not deaths.empty:
         row = row.combine_first(to_cum(row, deaths, "Deaths")).combine_first(deaths)
 
-    row = row.combine_first(workbook_value(wb, date, "D_Severe (2)", "Hospitalized Severe", None))
-    row = row.combine_first(workbook_value(wb, date, "D_SevereTube (2)", "Hospitalized Respirator", None))
-
     ages = workbook_series(wb, 'cvd_agegroup', {'Measure Values-value': 'Deaths',
                            "Measure Names-alias": "Age Group"}, index_col="Age Group", index_date=False)
     gender = workbook_series(wb, 'cvd_gender', {'Measure Values-value': 'Deaths',
@@ -284,7 +284,7 @@ def get_english_situation_files(check=False):
             break
 
         def dl_file(link=link):
-            for file, _, _ in web_files(link, dir=dir, check=check):
+            for file, _, _ in web_files(link, dir=dir, check=check, lazy=True):
                 return file  # Just want first
             # Missing file
             return None
@@ -500,7 +500,7 @@ def get_thai_situation_files(check=False):
         count += 1
 
         def dl_file(link=link):
-            for file, _, _ in web_files(link, dir="inputs/situation_th", check=check):
+            for file, _, _ in web_files(link, dir="inputs/situation_th", check=check, lazy=True):
                 return file  # Just want first
             # Missing file
             return None
@@ -17,7 +17,7 @@ from utils_scraping import camelot_cache
 from utils_scraping import get_next_numbers
 from utils_scraping import local_files
 from utils_scraping import logger
-from utils_scraping import parse_file
+from utils_scraping import parse_files
 from utils_scraping import pptx2chartdata
 from utils_scraping import USE_CACHE_DATA
 from utils_scraping import web_files
@@ -78,7 +78,7 @@ def get_drive_files(folder_id, ext="pdf", dir="inputs/testing_moph", check=True)
 
         def get_file(id=id, name=name):
             url = f"https://www.googleapis.com/drive/v2/files/{id}?alt=media&key={key}"
-            file, _, _ = next(iter(web_files(url, dir=dir, filenamer=lambda url, _: name)))
+            file, _, _ = next(iter(web_files(url, dir=dir, filenamer=lambda url, _: name, lazy=True)))
             return file
 
         yield target, get_file
@@ -89,6 +89,12 @@ def get_drive_files(folder_id, ext="pdf", dir="inputs/testing_moph", check=True)
         return
 
 
+def dl_file(item):
+    file, dl = item
+    dl()
+    return file
+
+
 def get_test_files(ext="pdf", dir="inputs/testing_moph", check=True):
     folder_id = "1yUVwstf5CmdvBVtKBs0uReV0BTbjQYlT"
     yield from get_drive_files(folder_id, ext, dir, check=check)
@@ -131,7 +137,7 @@ def get_tests_by_day():
 
     def from_data():
         url = "https://data.go.th/dataset/9f6d900f-f648-451f-8df4-89c676fce1c4/resource/0092046c-db85-4608-b519-ce8af099315e/download/thailand_covid-19_testing_data_update091064.csv"  # NOQA
-        file, _, _ = next(iter(web_files(url, dir="inputs/testing_moph")))
+        file, _, _ = next(iter(web_files(url, dir="inputs/testing_moph", lazy=True)))
         tests = pd.read_csv(file, parse_dates=True, usecols=[0, 1, 2])
         return file, tests.rename(columns={'positive': "Pos", 'Total Testing': "Total"})
 
@@ -331,9 +337,7 @@ def get_test_reports():
 
     # Also need pdf copies because of missing pptx
     raw_pdf = pd.DataFrame()
-    for file, dl in get_test_files(ext=".pdf"):
-        dl()
-        pages = parse_file(file, html=False, paged=True)
+    for (file, dl), _, pages in parse_files(get_test_files(ext=".pdf"), dl_file, html=False, paged=True):
         for page_num, page in enumerate(pages, start=1):
             data, raw_pdf = get_tests_by_area_pdf(file, page, data, raw_pdf, page_num)
 
@@ -615,9 +619,7 @@ def get_variant_reports():
         nat = nat.rename(columns={"B.1617.2 (Delta)": "B.1.617.2 (Delta)", "B.1.1.529 (Omicron": "B.1.1.529 (Omicron)"})
         break
 
-    for file, dl in get_variant_files(ext=".pdf"):
-        dl()
-        pages = parse_file(file, html=False, paged=True)
+    for (file, dl), _, pages in parse_files(get_variant_files(ext=".pdf"), dl_file, html=False, paged=True):
         # page 1 title
         # page 2 people + sample sizes
         # page 3 table year + week per variant (4) per district
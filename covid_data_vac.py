@@ -24,6 +24,7 @@ from utils_scraping import MAX_DAYS
 from utils_scraping import NUM_OR_DASH
 from utils_scraping import pairwise
 from utils_scraping import parse_file
+from utils_scraping import parse_files
 from utils_scraping import parse_numbers
 from utils_scraping import replace_matcher
 from utils_scraping import split
@@ -701,7 +702,7 @@ def vaccination_reports_files2(check=0,
         def get_file(link=link, check=check):
             try:
                 file, _, _ = next(iter(web_files(link, dir="inputs/vaccinations",
-                                  proxy=use_proxy, timeout=timeout, check=check)))
+                                  proxy=use_proxy, timeout=timeout, check=check, lazy=True)))
             except StopIteration:
                 return None
             return file
@@ -719,11 +720,11 @@ def vaccination_reports():
     # add in newer https://ddc.moph.go.th/uploads/ckeditor2//files/Daily%20report%202021-06-04.pdf
     # Just need the latest
 
-    for link, date, dl in vaccination_reports_files2(check=0):
-        if (file := dl()) is None:
+    for (link, date, dl), file, pages in parse_files(vaccination_reports_files2(check=0), lambda item: item[2]()):
+        if file is None:
             continue
         table = pd.DataFrame(columns=["Date", "Province"]).set_index(["Date", "Province"])
-        for page in parse_file(file):
+        for page in pages:
             if date is None:
                 *rest, with_date = page.split("ข้อมูล", 2)
                 if rest:
@@ -1205,15 +1206,14 @@ def vac_slides_manuf(file, link):
 
 def vac_slides():
     df = pd.DataFrame(columns=['Date']).set_index("Date")
-    for link, _, get_file in vac_slides_files(check=0):
-        file = get_file()
+    for (link, _, get_file), file, pages in parse_files(vac_slides_files(check=0), lambda item: item[2]()):
         if file is None:
             continue
         date = file2date(file)
         groups = pd.DataFrame()
         if '1625816003470' in file:
             break  # TODO: can keep fixing asserts in groups before this but why?
-        for i, page in enumerate(parse_file(file), 1):
+        for i, page in enumerate(pages, 1):
             groups = groups.combine_first(vac_slides_groups(page, file, i))
 
         manuf = vac_slides_manuf(file, link)
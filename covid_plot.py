@@ -1,5 +1,6 @@
 import datetime
 import pathlib
+import tempfile
 import time
 from functools import partial
 from multiprocessing import Pool
@@ -14,13 +15,20 @@ import covid_plot_deaths
 import covid_plot_tests
 import covid_plot_vacs
 from covid_data import scrape_and_combine
+from utils_pandas import from_handle
+from utils_pandas import to_handle
 from utils_scraping import logger
+from utils_thai import get_provinces
 
 
 def do_work(job, df):
     global job_data
+    job, uses = job
     start = time.time()
     logger.info(f"==== Plot: {job.__name__} Start ====")
+    # the save_*_plots do their own arithmetic so give them back float64 for the columns they use.
+    # plot_area makes anything else it plots float64 too
+    df = from_handle(df, float64=uses)
     data = job(df)
     logger.info(f"==== Plot: {job.__name__} in {datetime.timedelta(seconds=time.time() - start)} ====")
     return (job.__name__, data)
@@ -36,21 +44,26 @@ def save_plots(df: pd.DataFrame) -> None:
     # create directory if it does not exists
     pathlib.Path('./outputs').mkdir(parents=True, exist_ok=True)
 
+    # each job and the prefixes of the columns it does arithmetic with
     jobs = [
-        covid_plot_cases.save_caseprov_plots,
-        covid_plot_cases.save_cases_plots,
-        covid_plot_tests.save_test_area_plots,
-        covid_plot_tests.save_variant_plots,
-        covid_plot_vacs.save_vacs_plots,
-        covid_plot_vacs.save_vacs_prov_plots,
-        covid_plot_active.save_active_plots,
-        covid_plot_deaths.save_deaths_plots,
-        covid_plot_deaths.save_excess_death_plots,
-        covid_plot_tests.save_tests_plots,
+        (covid_plot_cases.save_caseprov_plots, ["Cases"]),
+        (covid_plot_cases.save_cases_plots, ["Cases", "Deaths", "Hospitalized", "Tests", "Pos"]),
+        (covid_plot_tests.save_test_area_plots, ["Cases", "Tests", "Pos"]),
+        (covid_plot_tests.save_variant_plots, ["Cases", "Deaths", "Hospitalized"]),
+        (covid_plot_vacs.save_vacs_plots, ["Vac", "Cases", "Deaths", "Tests", "Pos", "ATK"]),
+        (covid_plot_vacs.save_vacs_prov_plots, ["Vac"]),
+        (covid_plot_active.save_active_plots, ["Hospitalized", "Cases", "Deaths", "Recovered"]),
+        (covid_plot_deaths.save_deaths_plots, ["Deaths", "Cases", "Hospitalized"]),
+        (covid_plot_deaths.save_excess_death_plots, ["Deaths", "Cases"]),
+        (covid_plot_tests.save_tests_plots, ["Tests", "Pos", "Cases", "ATK", "PUI", "Infections"]),
     ]
 
-    with Pool() as pool:
-        res = dict(pool.imap_unordered(partial(do_work, df=df), jobs))
+    get_provinces()  # load the province index once here so the forked workers share it
+
+    # Write df once and let each worker map it in, rather than pickling it to every worker.
+    # float32 where it's exact so the shared file is smaller
+    with tempfile.TemporaryDirectory(prefix="covid_plot_") as share_dir, Pool() as pool:
+        res = dict(pool.imap_unordered(partial(do_work, df=to_handle(df, share_dir, compact=True)), jobs))
         pool.close()
         pool.join()
     logger.info(f"data={len(res)}")
@@ -14,6 +14,7 @@ from utils_pandas import cut_ages_labels
 from utils_pandas import decreasing
 from utils_pandas import get_cycle
 from utils_pandas import import_csv
+from utils_pandas import import_partitioned
 from utils_pandas import increasing
 from utils_pandas import perc_format
 from utils_pandas import rearrange
@@ -134,7 +135,7 @@ def save_cases_plots(df: pd.DataFrame) -> None:
               footnote_left=f'{source}Data Source: API: Daily Reports of COVID-19 Infections')
 
     """ Thailand Covid Cases by Nationality """
-    cases = import_csv("covid-19", dir="inputs/json", date_cols=["Date", "update_date", "txn_date"])
+    cases = import_partitioned("covid-19", dir="inputs/json")
     # List out all nationalities by number of occurrences, select only 5 largest nationalities excluding Thai and others(non-labled)
     nat_index = cases['nationality'].value_counts().index
     top5_list = nat_index[~nat_index.isin(['Thai', 'Others'])][:8]
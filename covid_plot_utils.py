@@ -20,6 +20,7 @@ from matplotlib.offsetbox import OffsetImage
 from matplotlib.offsetbox import TextArea
 from matplotlib.ticker import FuncFormatter
 
+from utils_pandas import dense
 from utils_pandas import get_cycle
 from utils_pandas import human_format
 from utils_pandas import perc_format
@@ -139,6 +140,11 @@ def plot_area(df: pd.DataFrame,
 
     orig_cols = cols
 
+    # Only the columns we use so the assigns below don't copy the whole wide frame each time
+    box = [c for dist in box_cols for c in (dist if isinstance(dist, list) else [dist])]
+    extra = [c for c in [unknown_total, unknown_name] if c] + (actuals if isinstance(actuals, list) else []) + between + box
+    df = dense(df, list(cols) + extra)
+
     plt.rcParams.update({
         "font.size": 20,
         "figure.titlesize": 30,
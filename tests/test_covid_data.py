@@ -0,0 +1,67 @@
+import os
+
+import pandas as pd
+import pytest
+
+from covid_data import run_dag
+
+
+def scrape_a():
+    return pd.DataFrame({"A": [1.0, 2.0], "pid A": os.getpid()}, index=pd.Index([1, 2], name="Date"))
+
+
+def scrape_b():
+    return pd.DataFrame({"B": [3.0], "pid B": os.getpid()}, index=pd.Index([2], name="Date"))
+
+
+def scrape_c():
+    return os.getpid()
+
+
+def scrape_fails():
+    raise ValueError("scraper broke")
+
+
+def test_run_dag():
+    calls = []
+
+    def combine(scrape_a, scrape_b):
+        calls.append("combine")
+        return scrape_a.combine_first(scrape_b)
+
+    def total(combine, scrape_c):
+        calls.append("total")
+        return combine["A"].sum() + combine["B"].sum(), os.getpid()
+
+    steps = [
+        (total, ["combine", "scrape_c"], "main"),  # listed before what it needs
+        (combine, ["scrape_a", "scrape_b"], "main"),
+        (scrape_a, [], "slow"),
+        (scrape_b, [], "slow"),
+        (scrape_c, [], "fast"),
+    ]
+    res = run_dag(steps, dict(slow=1, fast=2))
+    assert calls == ["combine", "total"]
+    assert res["total"] == (6.0, os.getpid())  # main steps run in this process
+    expected = pd.DataFrame({"A": [1.0, 2.0], "B": [None, 3.0]}, index=pd.Index([1, 2], name="Date"))
+    pd.testing.assert_frame_equal(res["combine"][["A", "B"]], expected)
+    # scrapers run in the pool for their lane. slow only has one process
+    pid_a, pid_b = res["scrape_a"]["pid A"].iloc[0], res["scrape_b"]["pid B"].iloc[0]
+    assert pid_a == pid_b != os.getpid()
+    assert res["scrape_c"] not in [os.getpid(), pid_a]
+
+
+def test_run_dag_error():
+    def never(scrape_fails):
+        raise AssertionError("shouldn't run without its input")
+
+    with pytest.raises(ValueError, match="scraper broke"):
+        run_dag([(scrape_fails, [], "slow"), (never, ["scrape_fails"], "main")], dict(slow=1))
+
+
+def test_run_dag_unknown_dep():
+    def combine(missing):
+        return missing
+
+    with pytest.raises(AssertionError, match="unknown steps"):
+        run_dag([(combine, ["missing"], "main")], {})
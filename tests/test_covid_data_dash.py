@@ -0,0 +1,105 @@
+import datetime
+import types
+
+import pandas as pd
+import pytest
+
+import covid_data_dash
+from utils_pandas import export
+
+
+def test_usual_ready_time(monkeypatch):
+    monkeypatch.setattr(covid_data_dash, "today", lambda: datetime.datetime(2022, 2, 1, 6, 0))
+    ready = ["2022-01-01 10:00", "2022-01-02 11:00", "2022-01-03 10:30", "2022-01-04 9:45"]
+    history = pd.DataFrame({"Ready": ready})
+    times = pd.to_datetime(pd.Series(ready))
+    median = (times - times.dt.normalize()).median()
+    assert covid_data_dash.usual_ready_time(history) == datetime.datetime(2022, 2, 1) + median
+    assert covid_data_dash.usual_ready_time(history, days=1) == datetime.datetime(2022, 2, 1, 9, 45)
+    assert covid_data_dash.usual_ready_time(history.iloc[:0]) is None
+
+
+@pytest.mark.parametrize("cap", [60, 30 * 60])
+def test_backoff(cap):
+    for errors in range(1, 10):
+        secs = covid_data_dash.backoff(errors, base=60, cap=cap)
+        assert min(cap, 60 * 2 ** (errors - 1) * 0.5) <= secs <= cap
+
+
+class Clock:
+    "today(), time.time() and time.sleep() for todays_data that only move when it sleeps"
+
+    def __init__(self, now):
+        self.now = now
+        self.sleeps = []
+
+    def today(self):
+        return self.now
+
+    def time(self):
+        return self.now.timestamp()
+
+    def sleep(self, secs):
+        self.sleeps.append((self.now, secs))
+        self.now += datetime.timedelta(seconds=secs)
+
+
+@pytest.fixture
+def dashboard(tmp_path, monkeypatch):
+    "todays_data against a dashboard that updates at 10:30 and fails to load the first 10 times after 10:00"
+    monkeypatch.chdir(tmp_path)
+    clock = Clock(datetime.datetime(2022, 2, 1, 6, 0))
+    dash = types.SimpleNamespace(clock=clock, loads=[], published=[], failed=[], errors=10)
+
+    def dash_has_today(url):
+        dash.loads.append(clock.now)
+        if clock.now.hour >= 10 and dash.errors > 0:
+            dash.errors -= 1
+            dash.failed.append(clock.now)
+            raise ValueError("D_UpdateTime missing")
+        return clock.now >= datetime.datetime(2022, 2, 1, 10, 30)
+
+    def tableau_published(url, verify=True):
+        dash.published.append(clock.now)
+        return datetime.datetime(2022, 2, 1, 10, 30) if clock.now >= datetime.datetime(2022, 2, 1, 10, 30) else None
+
+    monkeypatch.setattr(covid_data_dash, "today", clock.today)
+    monkeypatch.setattr(covid_data_dash, "time", types.SimpleNamespace(time=clock.time, sleep=clock.sleep))
+    monkeypatch.setattr(covid_data_dash, "dash_has_today", dash_has_today)
+    monkeypatch.setattr(covid_data_dash, "tableau_published", tableau_published)
+    return dash
+
+
+def ready_history(*times):
+    return pd.DataFrame({"Ready": list(times)},
+                        index=pd.DatetimeIndex([pd.Timestamp(t).normalize() for t in times], name="Date"))
+
+
+@pytest.mark.parametrize("usual", [None, "2022-01-31 09:00:00", "2022-01-31 11:00:00"])
+def test_todays_data(dashboard, usual):
+    if usual is not None:
+        export(ready_history(usual), covid_data_dash.DASH_READY, csv_only=True, dir="inputs/json")
+    assert covid_data_dash.todays_data()
+    clock = dashboard.clock
+    seen = pd.to_datetime(pd.read_csv("inputs/json/dash_ready.csv")["Ready"]).iloc[-1]
+    usual = None if usual is None else pd.Timestamp(usual).time()
+    # noticed within a poll of it being updated, first looking or the last error. Backing off an error before the
+    # usual time can wait till then
+    looked = max(datetime.datetime(2022, 2, 1, 10, 30), dashboard.failed[-1])
+    if usual is not None:
+        usual_today = datetime.datetime.combine(seen.date(), usual)
+        looked = max(looked, usual_today - datetime.timedelta(minutes=10))
+        if dashboard.failed[-1] < usual_today:
+            looked = max(looked, usual_today)
+    assert seen <= looked + datetime.timedelta(seconds=covid_data_dash.DASH_POLL_SECS)
+    assert seen >= datetime.datetime(2022, 2, 1, 10, 30)
+    for now, secs in clock.sleeps:
+        if usual is None or now.time() >= usual:
+            assert secs <= covid_data_dash.DASH_POLL_SECS
+    if usual is not None:
+        # slept till just before the usual time and only loaded the workbook when it was likely to be there
+        assert clock.sleeps[0] == (datetime.datetime(2022, 2, 1, 6, 0), (usual.hour - 6) * 3600 - 10 * 60)
+    # another run today doesn't need to check again
+    dashboard.loads.clear()
+    assert covid_data_dash.todays_data()
+    assert dashboard.loads == []
@@ -0,0 +1,196 @@
+import difflib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import utils_pandas
+from utils_pandas import export
+from utils_pandas import export_partitioned
+from utils_pandas import from_handle
+from utils_pandas import import_csv
+from utils_pandas import import_partitioned
+from utils_pandas import json_chunks
+from utils_pandas import to_handle
+from utils_pandas import trendline
+
+
+def to_json_without_nulls(df, orient):
+    "What to_json gives but without the missing values json_chunks leaves out"
+    data = json.loads(df.to_json(date_format="iso", orient=orient))
+    if orient == "records":
+        return [{k: v for k, v in row.items() if v is not None} for row in data]
+    else:
+        return {col: {k: v for k, v in rows.items() if v is not None} for col, rows in data.items()}
+
+
+@pytest.mark.parametrize("orient", ["records", "columns"])
+@pytest.mark.parametrize("chunksize", [1, 2, 1000])
+def test_json_chunks(orient, chunksize):
+    df = pd.DataFrame({
+        "Date": pd.to_datetime(["2021-01-01", None, "2021-01-03"]),
+        "Cases": [1.5, None, 1 / 3],
+        "Deaths": [1, 2, 3],
+        "Province": ["Bangkok", None, "กระบี่"],
+        "Mixed": pd.Series([np.int64(4), pd.Timestamp("2021-02-01"), pd.NaT], dtype=object),
+        "Flag": [True, False, True],
+    })
+    result = json.loads("".join(json_chunks(df, orient=orient, chunksize=chunksize)))
+    assert result == to_json_without_nulls(df, orient)
+
+
+def cum_frame(seed, nprov=5, ndays=60, ncols=3):
+    "ragged Date, Province frame of cumulative values with gaps and the odd dip"
+    rng = np.random.default_rng(seed)
+    rows = []
+    for p in range(nprov):
+        start = pd.Timestamp("2021-01-01") + pd.Timedelta(days=int(rng.integers(0, 10)))
+        days = sorted(rng.choice(ndays, size=ndays * 2 // 3, replace=False))
+        values = np.cumsum(rng.integers(0, 10, size=(len(days), ncols)), axis=0).astype(float)
+        values[rng.random(values.shape) < 0.2] = np.nan
+        values[rng.random(values.shape) < 0.05] -= 3
+        for day, row in zip(days, values):
+            rows.append([start + pd.Timedelta(days=int(day)), f"P{p}"] + list(row))
+    columns = [f"C{i} Cum" for i in range(ncols - 1)] + ["Other"]
+    return pd.DataFrame(rows, columns=["Date", "Province"] + columns).set_index(["Date", "Province"])
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_combine_all(seed):
+    rng = np.random.default_rng(seed)
+    frames = []
+    for i in range(4):
+        index = pd.date_range("2021-01-01", periods=20, name="Date")[sorted(rng.choice(20, 12, replace=False))]
+        columns = list(rng.choice(["A", "B", "C", "D"], 2 + i % 2, replace=False))
+        df = pd.DataFrame(rng.random((len(index), len(columns))), index=index, columns=columns)
+        frames.append(df.mask(rng.random(df.shape) < 0.3))
+    frames[1]["S"] = "x"
+    expected = frames[0]
+    for df in frames[1:]:
+        expected = expected.combine_first(df)
+    pd.testing.assert_frame_equal(utils_pandas.combine_all(frames), expected)
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("drop", [True, False])
+def test_cum2daily_wide(seed, drop, monkeypatch):
+    df = cum_frame(seed)
+    fast = utils_pandas.cum2daily(df, drop=drop)
+    # the original groupby().apply() for each province
+    monkeypatch.setattr(utils_pandas, "_can_cum2daily_wide", lambda cum: False)
+    slow = utils_pandas.cum2daily(df, drop=drop)
+    pd.testing.assert_frame_equal(fast, slow)
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("days", [0, 3, 20])
+def test_cum2daily_incremental(seed, days):
+    new = cum_frame(seed, ndays=120)
+    dates = new.index.get_level_values("Date")
+    old = new[dates < dates.max() - pd.Timedelta(days=days)]
+    previous = utils_pandas.cum2daily(old, drop=False)
+    full = utils_pandas.cum2daily(new, drop=False)
+    pd.testing.assert_frame_equal(utils_pandas.cum2daily(new, drop=False, previous=previous), full, rtol=1e-12)
+
+
+def test_weekly2daily_incremental():
+    weekly = pd.DataFrame({"A": np.arange(40.0), "B Cum": np.arange(40.0)},
+                          index=pd.date_range("2021-01-03", periods=40, freq="7D", name="Date"))
+    weekly.iloc[5, 0] = np.nan
+    full = utils_pandas.weekly2daily(weekly)
+    for cut in [1, 2, 10]:
+        previous = utils_pandas.weekly2daily(weekly.iloc[:-cut])
+        since = weekly.index[-cut]
+        pd.testing.assert_frame_equal(utils_pandas.weekly2daily(weekly, previous=previous, since=since), full, check_freq=False)
+
+
+@pytest.mark.parametrize("storage", ["feather", "parquet"])
+@pytest.mark.parametrize("rows", [0, 1, 4])
+def test_import_csv_store(storage, rows, tmp_path, monkeypatch):
+    monkeypatch.setattr(utils_pandas, "STORAGE", storage)
+    monkeypatch.setattr(utils_pandas, "STORE_DIR", str(tmp_path / "store"))
+    df = pd.DataFrame({
+        "Date": pd.to_datetime(["2021-01-01", None, "2021-01-03", "2021-01-04"]),
+        "Other Date": ["2021-01-01", "2021-02-01", None, "2021-04-01"],
+        "Province": ["Bangkok", None, "กระบี่", "Phuket"],
+        "Code": ["01", "2", None, "0004"],
+        "Number Text": ["1", "2", None, "4"],
+        "Count": [1, 2, 3, 4],
+        "Cases": [1.5, None, 1 / 3, 4.0],
+        "Flag": [True, None, False, True],
+        "Empty": [None] * 4,
+    }).iloc[:rows]
+    export(df, "store_test", csv_only=True, dir=str(tmp_path))
+    path = tmp_path / "store_test.csv"
+    for kwargs, read_args in [
+        (dict(), dict(parse_dates=["Date"])),
+        (dict(date_cols=["Date", "Other Date"], str_cols=["Code", "Number Text"], int_cols=["Count"]),
+         dict(parse_dates=["Date", "Other Date"], dtype={"Code": "str", "Number Text": "str", "Count": "int"})),
+    ]:
+        expected = pd.read_csv(path, **read_args)
+        for _ in range(2):  # parse the csv and then from the stored copy
+            result = import_csv("store_test", dir=str(tmp_path), **kwargs)
+            pd.testing.assert_frame_equal(result, expected)
+            # assert_frame_equal counts None and NaN as the same
+            pd.testing.assert_frame_equal(result.apply(lambda col: col.map(type)), expected.apply(lambda col: col.map(type)))
+        assert os.path.exists(utils_pandas.store_path("store_test", str(tmp_path)))
+
+
+def test_handle_compact(tmp_path):
+    df = pd.DataFrame({
+        "Cases": [1.0, None, 3.0],
+        "Cases Rate": [0.1, 0.2, None],  # not exact as float32
+        "Deaths": [1.0, 2.0, None],
+        "Province": ["Bangkok", None, "Phuket"],
+    }, index=pd.DatetimeIndex(["2021-01-01", "2021-01-02", "2021-01-04"], name="Date"))
+    result = from_handle(to_handle([df, 1], str(tmp_path), compact=True), float64=["Cases"])
+    assert result[1] == 1
+    assert result[0].dtypes.to_dict() == dict(Cases=np.float64, **{"Cases Rate": np.float64}, Deaths=np.float32,
+                                              Province=object)
+    pd.testing.assert_frame_equal(result[0], df, check_dtype=False)
+    pd.testing.assert_frame_equal(from_handle(to_handle(df, str(tmp_path))), df)
+
+
+def test_close_matches(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils_pandas, "FUZZY_CACHE_DIR", str(tmp_path))
+    candidates = ["Bangkok", "Chiang Mai", "Chiang Rai", "Nakhon Ratchasima", "Nakhon Pathom", "Nakhon Sawan", "Phuket"]
+    words = ["Bangkock", "Chiangmai", "ChiangRai", "Nakorn Ratchasima", "Nakhonpathom", "Phucket", "xyz", "Bangkok"]
+    expected = {w: next(iter(difflib.get_close_matches(w, candidates, 1, cutoff=0.74)), None) for w in words}
+    assert utils_pandas.close_matches(words, candidates) == expected
+    # and again from what it remembered
+    assert utils_pandas.close_matches(words, candidates) == expected
+
+
+@pytest.mark.parametrize("how, ma", [("mean", 1), ("mean", 3), ("mean", 7), ("mean", 14), ("trend", 3), ("trend", 14)])
+def test_group_rolling(how, ma):
+    rng = np.random.default_rng(ma)
+    index = pd.MultiIndex.from_product([pd.date_range("2021-01-01", periods=40, name="Date"), ["A", "B", "C"]])
+    index = index.set_names(["Date", "Province"])
+    series = pd.Series(rng.random(len(index)) * 100, index=index, name="Cases")
+    series[rng.random(len(series)) < 0.1] = np.nan
+    series = series[rng.random(len(series)) < 0.9]  # not every province every day
+
+    def rolling(s):
+        s = s.rolling(ma, min_periods=int(ma / 2), center=True)
+        return s.mean() if how == "mean" else s.apply(trendline)
+    expected = series.groupby("Province", group_keys=False).apply(rolling).reindex(series.index)
+    result = utils_pandas.group_rolling(series, "Province", ma, how)
+    np.testing.assert_allclose(result.to_numpy(), expected.to_numpy(), rtol=1e-9)
+
+
+def test_export_partitioned(tmp_path):
+    rng = np.random.default_rng(0)
+    dates = pd.to_datetime(["2021-01-01", None]).append(pd.date_range("2021-01-01", periods=60, freq="D").repeat(3))
+    df = pd.DataFrame({"Date": dates, "Province": rng.choice(["Bangkok", "Phuket"], len(dates)), "Age": rng.random(len(dates))})
+    df = df.sort_values("Date", kind="stable", na_position="first").reset_index(drop=True)
+    export_partitioned(df, "cases", dir=str(tmp_path))
+    pd.testing.assert_frame_equal(import_partitioned("cases", dir=str(tmp_path)), df)
+    # only the changed week gets written and it still all reads back
+    df.loc[len(df) - 1, "Age"] = 1.0
+    export_partitioned(df, "cases", dir=str(tmp_path))
+    pd.testing.assert_frame_equal(import_partitioned("cases", dir=str(tmp_path)), df)
+    start, end = pd.Timestamp("2021-01-10"), pd.Timestamp("2021-01-20")
+    expected = df[(df["Date"] >= start) & (df["Date"] <= end)].reset_index(drop=True)
+    pd.testing.assert_frame_equal(import_partitioned("cases", dir=str(tmp_path), start=start, end=end), expected)
@@ -0,0 +1,108 @@
+import datetime
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import utils_scraping_tableau
+from utils_scraping_tableau import gray_product
+from utils_scraping_tableau import workbook_iterate
+from utils_scraping_tableau import workbook_value
+from utils_scraping_tableau import workbook_values
+
+
+class Worksheet:
+    def __init__(self, name, data=None):
+        self.name = name
+        self.data = pd.DataFrame() if data is None else data
+
+
+class Workbook:
+    def __init__(self, worksheets):
+        self.worksheets = worksheets
+
+    def getWorksheet(self, name):
+        return next((ws for ws in self.worksheets if ws.name == name), Worksheet(name))
+
+
+class ScraperWorkbook:
+    "Just enough of a tableauscraper workbook for workbook_iterate to set params on"
+
+    def __init__(self, scraper):
+        self._scraper = scraper
+        self.state = dict(scraper.state)
+        self.worksheets = [Worksheet("A"), Worksheet("B")]
+
+    def getParameters(self):
+        return [{"column": "p1", "values": ["a", "b", "c"]}, {"column": "p2", "values": list(range(6))}]
+
+
+class Scraper:
+    def __init__(self, verify=True):
+        self.session = None
+        self.state = {}
+
+    def loads(self, url):
+        pass
+
+    def getWorkbook(self):
+        return ScraperWorkbook(self)
+
+
+def set_param(wb, name, value):
+    wb._scraper.state[name] = value
+    return ScraperWorkbook(wb._scraper)
+
+
+@pytest.fixture
+def tableau(monkeypatch):
+    monkeypatch.setattr(utils_scraping_tableau.tableauscraper, "TableauScraper", Scraper)
+    monkeypatch.setattr(utils_scraping_tableau, "fix_timeouts", lambda *args, **kwargs: None)
+    monkeypatch.setattr(utils_scraping_tableau, "force_setParameter", set_param)
+
+
+def iterate(sessions, ordered=True, skip=None):
+    "(combination, what its workbook was set to) for each one workbook_iterate yields"
+    results = []
+    for get_wb, idx in workbook_iterate("url", sessions=sessions, ordered=ordered, skip=skip, p1="p1", p2="p2"):
+        wb = get_wb()
+        results.append((idx, (wb.state["p1"], wb.state["p2"])))
+    return results
+
+
+@pytest.mark.parametrize("skip, count", [(None, 18), (lambda idx: idx[1] % 2 == 0, 9), (lambda idx: idx[0] == "b", 12)])
+def test_workbook_iterate_sessions(tableau, skip, count):
+    expected = iterate(1, skip=skip)
+    assert len(expected) == count
+    assert all(idx == state for idx, state in expected)
+    assert iterate(2, skip=skip) == expected
+    assert iterate(3, skip=skip) == expected
+    assert sorted(iterate(2, ordered=False, skip=skip)) == sorted(expected)
+
+
+@pytest.mark.parametrize("values", [("ab", [1, 2, 3]), ("ab", "xyz", [1, 2]), ([None, 1], "abc", "xy", [3])])
+def test_gray_product(values):
+    combinations = gray_product(*values)
+    assert sorted(combinations, key=str) == sorted(itertools.product(*values), key=str)
+    # each step changes just one value
+    for a, b in zip(combinations, combinations[1:]):
+        assert sum(x != y for x, y in zip(a, b)) == 1
+
+
+def test_workbook_values():
+    wb = Workbook([
+        Worksheet("A", pd.DataFrame({"x-alias": ["1,234"]})),
+        Worksheet("B (2)", pd.DataFrame({"y": [5]})),
+        Worksheet("C", pd.DataFrame()),
+        Worksheet("D", pd.DataFrame({"z": ["%null%"]})),
+        Worksheet("E", pd.DataFrame({"z": [2.5]})),
+    ])
+    date = datetime.datetime(2022, 3, 4, 10, 5)
+    spec = [("a", "A", 0.0), ("b", ["B", "B (2)"], 0.0), ("c", "C", np.nan), ("c2", "C", None), ("c3", "C", 0.0),
+            ("d", "D", 0.0), ("e", "E", None), ("m", "Missing", np.nan), ("m2", ["X", "Y"], 0.0)]
+    expected = pd.DataFrame()
+    for col, name, default in spec:
+        expected = expected.combine_first(workbook_value(wb, date, name, col, default))
+    result = pd.DataFrame().combine_first(workbook_values(wb, date, {c: n for c, n, _ in spec}, {c: d for c, _, d in spec}))
+    pd.testing.assert_frame_equal(result.sort_index(axis=1), expected.sort_index(axis=1))
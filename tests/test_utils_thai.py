@@ -0,0 +1,53 @@
+import csv
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import utils_thai
+from utils_thai import add_alias
+from utils_thai import count_alias
+from utils_thai import get_fuzzy_provinces
+from utils_thai import save_aliases
+from utils_thai import trend_table
+
+
+def guess(i):
+    count_alias("กทม", "Bangkok", i)
+    add_alias(f"กระบี่{i}", "Krabi")
+
+
+def test_save_aliases_from_workers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(utils_thai, "_aliases", None)
+    with open(tmp_path / "previous.csv", "w", newline="") as fp:
+        csv.writer(fp).writerow(["กทม", "Bangkok", 5])
+    monkeypatch.setattr(utils_thai, "PROVINCE_ALIASES", str(tmp_path / "previous.csv"))
+
+    with Pool(2) as pool:
+        pool.map(guess, [1, 2, 3])
+    add_alias("กทม", "Bangkok", 10)
+
+    fuzzy = get_fuzzy_provinces()["count"].to_dict()
+    assert fuzzy == {("กทม", "Bangkok"): 16, ("กระบี่1", "Krabi"): 1, ("กระบี่2", "Krabi"): 1, ("กระบี่3", "Krabi"): 1}
+    save_aliases()
+    with open(tmp_path / "previous.csv", newline="") as fp:
+        saved = {(prov, proven): int(count) for prov, proven, count in csv.reader(fp)}
+    assert saved == {key: count + (5 if key[0] == "กทม" else 0) for key, count in fuzzy.items()}
+    assert get_fuzzy_provinces().empty  # run counts are cleared once saved
+
+
+@pytest.mark.parametrize("style", ["green_up", "rank_up", "abs"])
+def test_trend_table_row_order(style, monkeypatch):
+    provinces = pd.DataFrame({"Population": [10e6, 0.4e6, 0.5e6]}, index=pd.Index(["Bangkok", "Phuket", "Krabi"]))
+    monkeypatch.setattr(utils_thai, "get_provinces", lambda: provinces)
+    monkeypatch.setattr(utils_thai, "join_provinces", lambda df, on, extra: df)
+    rng = np.random.default_rng(0)
+    index = pd.MultiIndex.from_product([pd.date_range("2021-01-01", periods=30, name="Date"), provinces.index])
+    series = pd.Series(rng.random(len(index)) * 100, index=index.set_names(["Date", "Province"]), name="Cases")
+    expected = trend_table(series, style=style)
+    shuffled = trend_table(series.sample(frac=1, random_state=1), style=style)
+    pd.testing.assert_frame_equal(shuffled.loc[expected.index], expected)
+    by_province = trend_table(series.swaplevel().sort_index(), style=style)
+    pd.testing.assert_frame_equal(by_province.loc[expected.index], expected)
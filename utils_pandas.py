@@ -1,8 +1,13 @@
+import collections
 import datetime
 import difflib
 import functools
+import gzip
+import hashlib
+import json
 import math
 import os
+import tempfile
 from typing import List
 from typing import Union
 
@@ -11,6 +16,8 @@ import matplotlib.dates as mdates
 import mpld3
 import numpy as np
 import pandas as pd
+import pyarrow
+import pyarrow.feather
 from cycler import Cycler
 from dateutil.parser import parse as d
 from dateutil.relativedelta import relativedelta
@@ -52,6 +59,73 @@ def add_data(data, df):
     return data
 
 
+def combine_all(frames):
+    """
+    Same as frames[0].combine_first(frames[1]).combine_first(frames[2])... but the union of the index and columns
+    is worked out once and then each column is filled from the frames in priority order.
+    Only dtypes can differ in odd cases, e.g. an empty frame with int columns.
+
+    >>> a = pd.DataFrame({"A": [1.0, None]}, index=[1, 2])
+    >>> b = pd.DataFrame({"A": [5.0, 6.0, 7.0], "B": ["x", "y", "z"]}, index=[1, 2, 3])
+    >>> combine_all([a, b]).equals(a.combine_first(b))
+    True
+    >>> combine_all([a, b])
+         A  B
+    1  1.0  x
+    2  6.0  y
+    3  7.0  z
+    """
+    index, columns, sources = None, None, []
+    for f in frames:
+        if index is None:
+            index, columns, sources = f.index, f.columns, [f]
+            continue
+        dupes = index.has_duplicates or f.index.has_duplicates or columns.has_duplicates or f.columns.has_duplicates
+        if dupes or index.names != f.index.names:
+            # align can't do these in one go. Just do it the slow way
+            result = frames[0]
+            for f in frames[1:]:
+                result = result.combine_first(f)
+            return result
+        # follow what combine_first does incl its shortcuts for empty frames
+        if len(f) == 0:
+            columns = columns.append(f.columns.difference(columns))
+            sources.append(f)
+            continue
+        new_index = index if index.equals(f.index) else index.join(f.index, how="outer")
+        new_columns = columns if columns.equals(f.columns) else columns.join(f.columns, how="outer")
+        if (len(new_index) == 0 or len(new_columns) == 0) and len(new_index) == len(index):
+            continue
+        if (len(index) == 0 or len(columns) == 0) and len(f) == len(new_index):
+            sources = []  # combine_first just takes f
+        index, columns = new_index, new_columns
+        sources.append(f)
+    if len(sources) == 1 and sources[0].columns.equals(columns):
+        return sources[0].copy()
+
+    aligned = [f.reindex(index) if not f.index.equals(index) else f for f in sources]  # each one realigned once
+    result = {}
+    for col in columns:
+        series = [f[col] for f in aligned if col in f.columns]
+        if not series:
+            result[col] = np.full(len(index), np.nan)
+        elif all(pd.api.types.is_float_dtype(s) for s in series):
+            dtype = np.result_type(*[s.dtype for s in series])
+            values = series[0].to_numpy(dtype=dtype, copy=True)
+            for s in series[1:]:
+                missing = np.isnan(values)
+                if not missing.any():
+                    break
+                values[missing] = s.to_numpy(dtype=dtype)[missing]
+            result[col] = values
+        else:
+            combined = series[0]
+            for s in series[1:]:
+                combined = combined.combine_first(s)
+            result[col] = combined.to_numpy()
+    return pd.DataFrame(result, index=index, columns=columns)
+
+
 def check_cum(df, results, cols):
     if results.empty:
         return True
@@ -63,7 +137,161 @@ def check_cum(df, results, cols):
         raise Exception(str(next_day - last))
 
 
-def cum2daily(results, exclude=[], drop=True, replace=True):
+def _interpolate_inside(values):
+    "interpolate(limit_area='inside') on every column of a 2d array at once. Same arithmetic as np.interp"
+    rows = np.arange(len(values))[:, None]
+    valid = ~np.isnan(values)
+    prev_i = np.maximum.accumulate(np.where(valid, rows, -1), axis=0)
+    next_i = np.minimum.accumulate(np.where(valid, rows, len(values))[::-1], axis=0)[::-1]
+    inside = ~valid & (prev_i >= 0) & (next_i < len(values))
+    prev_i, next_i = prev_i[inside], next_i[inside]
+    cols = np.nonzero(inside)[1]
+    prev_v, next_v = values[prev_i, cols], values[next_i, cols]
+    slope = (next_v - prev_v) / (next_i - prev_i).astype(float)
+    result = values.copy()
+    result[inside] = slope * (np.nonzero(inside)[0] - prev_i) + prev_v
+    return result
+
+
+def _can_cum2daily_wide(cum):
+    return not cum.empty and not cum.index.duplicated().any() and all(pd.api.types.is_numeric_dtype(t) for t in cum.dtypes)
+
+
+def _cum_wide(cum, level):
+    "Date x (col, group) frame over the full date range plus each groups first and last date"
+    dates = cum.index.get_level_values("Date")
+    groups = cum.index.get_level_values(level)
+    # each group only covers from its own first to last date
+    first = pd.Series(dates).groupby(groups).min()
+    last = pd.Series(dates).groupby(groups).max()
+    wide = cum.unstack(level)
+    wide = wide.reindex(pd.date_range(dates.min(), dates.max(), name="Date"))
+    return wide, first, last
+
+
+def _wide_daily(wide):
+    "the smoothing + diff of cum2daily's todaily on every column"
+    smoothed = wide.iloc[::-1].cummin().iloc[::-1]
+    smoothed = pd.DataFrame(_interpolate_inside(smoothed.to_numpy(dtype=float)), index=smoothed.index, columns=smoothed.columns)
+    daily = smoothed.diff()  # we got cumilitive data
+    renames = dict((c, c.rstrip(' Cum')) for c in wide.columns.get_level_values(0) if 'Cum' in c)
+    daily = daily.rename(columns=renames, level=0)
+    assert not (daily < 0).any().any()
+    return daily
+
+
+def _wide_long(daily, first, last, level, df_cum, drop):
+    "back to Date, level rows, only inside each groups date range"
+    daily = daily.stack(level, future_stack=True)
+    day = daily.index.get_level_values("Date")
+    group = daily.index.get_level_values(level)
+    in_range = (day >= first.reindex(group).to_numpy()) & (day <= last.reindex(group).to_numpy())
+    daily = daily[in_range]
+    daily.columns.name = None
+    if not drop:
+        # add back in the cum valuse
+        daily = daily.combine_first(df_cum)
+    # same order as groupby().apply(). Each group, in date order
+    order = np.lexsort([daily.index.get_level_values("Date"), daily.index.get_level_values(level)])
+    return daily.iloc[order].reorder_levels(["Date", level])
+
+
+def _cum2daily_wide(df_cum, level, drop):
+    "Same as cum2daily's todaily on each group of level, but done for all groups at once as columns of one frame"
+    cum = df_cum.loc[df_cum.index.get_level_values("Date").notnull()]
+    wide, first, last = _cum_wide(cum, level)
+    return _wide_long(_wide_daily(wide), first, last, level, df_cum, drop)
+
+
+def first_change(old, new):
+    """
+    Earliest Date where the values in new differ from old (rows added, removed or changed). None if the same.
+
+    >>> old = pd.DataFrame({"Date": pd.date_range("2022-01-01", periods=3), "A": [1, None, 3]}).set_index("Date")
+    >>> first_change(old, old.copy())
+    >>> new = old.copy()
+    >>> new.loc["2022-01-02", "A"] = 2
+    >>> first_change(old, new)
+    Timestamp('2022-01-02 00:00:00')
+    >>> first_change(old, old.iloc[:2])
+    Timestamp('2022-01-03 00:00:00')
+    """
+    old, new = old.align(new)
+    same = ((old == new) | (old.isna() & new.isna())).all(axis=1)
+    if same.all():
+        return None
+    return same.index[~same.to_numpy()].get_level_values("Date").min()
+
+
+def _cum2daily_incremental(df_cum, level, previous, window):
+    """
+    cum2daily(drop=False) for df_cum reusing the daily values in previous (last runs result) for dates before
+    the cumulative data changed. Only the tail from the first change minus window days is recomputed.
+    Returns None if a change could have effected earlier days so it needs a full recompute.
+    """
+    cum = df_cum.loc[df_cum.index.get_level_values("Date").notnull()]
+    renames = dict((c, c.rstrip(' Cum')) for c in cum.columns if 'Cum' in c)
+    if list(previous.index.names) != list(cum.index.names):
+        return None
+    if set(cum.columns) - set(previous.columns) or set(renames.values()) - set(previous.columns):
+        return None
+    old_cum = previous[list(cum.columns)]
+    since = first_change(old_cum.dropna(how="all"), cum.dropna(how="all"))
+    wide, first, last = _cum_wide(cum, level)
+    if since is None:
+        since = wide.index[-1] + pd.Timedelta(days=1)
+    start = since - pd.Timedelta(days=window)
+    if start <= wide.index[0]:
+        return None
+    # groups that started or finished before the tail have to be the same as last time
+    old_dates = previous.index.get_level_values("Date")
+    old_groups = previous.index.get_level_values(level)
+    if set(old_groups) - set(first.index):
+        return None  # a group went missing
+    old_first = pd.Series(old_dates).groupby(old_groups).min().reindex(first.index)
+    old_last = pd.Series(old_dates).groupby(old_groups).max().reindex(last.index)
+    if ((first < start) & (old_first != first)).any() or ((last < start) & (old_last != last)).any():
+        return None
+
+    old_wide = old_cum.unstack(level).reindex(index=wide.index, columns=wide.columns)
+    valid = wide.loc[:since - pd.Timedelta(days=1)].notna().to_numpy()
+    rows = np.arange(len(valid))[:, None]
+    last_valid = np.where(valid, rows, -1).max(axis=0)
+    # columns with nothing from since on, before or now, stay as they were
+    untouched = wide.loc[since:].isna().all().to_numpy() & old_wide.loc[since:].isna().all().to_numpy()
+    # otherwise interpolation before since has to be anchored by a value inside the window, or have nothing before at all
+    if (~untouched & (last_valid >= 0) & (last_valid < wide.index.get_loc(start))).any():
+        return None
+    # smoothing takes the min of everything after so earlier days only stay the same if that min is the
+    # same or not lower than the last value before since
+    old_min = old_wide.loc[since:].min().fillna(np.inf).to_numpy()
+    new_min = wide.loc[since:].min().fillna(np.inf).to_numpy()
+    before = wide.to_numpy(dtype=float)[np.maximum(last_valid, 0), np.arange(len(last_valid))]
+    unchanged = (old_min == new_min) | ((old_min >= before) & (new_min >= before)) | (last_valid < 0)
+    if not unchanged.all():
+        return None
+    last_valid[untouched] = len(wide)
+
+    # days before start are all as last time. After that each column switches to the new values after its anchor
+    tail = _wide_daily(wide.loc[start:])
+    old_daily = previous[list(renames.values())].unstack(level).reindex(index=tail.index, columns=tail.columns)
+    keep = np.arange(wide.index.get_loc(start), len(wide))[:, None] <= last_valid
+    daily = np.where(keep, old_daily.to_numpy(dtype=float), tail.to_numpy())
+    daily = pd.DataFrame(daily, index=tail.index, columns=tail.columns)
+    daily = _wide_long(daily, first, last, level, df_cum.loc[~(df_cum.index.get_level_values("Date") < start)], drop=False)
+    head = previous.loc[previous.index.get_level_values("Date") < start, list(daily.columns)]
+    daily = pd.concat([head, daily])
+    order = np.lexsort([daily.index.get_level_values("Date"), daily.index.get_level_values(level)])
+    return daily.iloc[order]
+
+
+def cum2daily(results, exclude=[], drop=True, replace=True, previous=None, window=28):
+    """
+    Turn the " Cum" columns into daily values, smoothing out any decreases.
+
+    previous can be the result from the last run (with drop=False) in which case only the days from
+    where the cumulative data changed, less window days, get recomputed and the rest is reused.
+    """
     def todaily(df_cum):
         if df_cum.empty:
             return df_cum
@@ -96,7 +324,16 @@ def cum2daily(results, exclude=[], drop=True, replace=True):
     cum = results[cumcols]
     inames = cum.index.names
     otherindex = list(set(inames) - set(["Date"]))
-    if otherindex:
+    incremental = None
+    if previous is not None and not previous.empty and not drop and len(otherindex) == 1 and _can_cum2daily_wide(cum):
+        incremental = _cum2daily_incremental(cum, otherindex[0], previous, window)
+        if incremental is None:
+            logger.info("cum2daily: data changed too far back to reuse previous. Full recompute")
+    if incremental is not None:
+        cum = incremental
+    elif len(otherindex) == 1 and _can_cum2daily_wide(cum):
+        cum = _cum2daily_wide(cum, otherindex[0], drop)
+    elif otherindex:
         cum = cum.groupby(otherindex, group_keys=False).apply(todaily)
     else:
         cum = todaily(cum)
@@ -116,18 +353,29 @@ def cum2daily(results, exclude=[], drop=True, replace=True):
 #     return weekly.reindex(pd.date_range(weekly.index.min(), weekly.index.max(), name="Date")).cumsum().interpolate().diff()
 
 
-def weekly2daily(df):
+def weekly2daily(df, previous=None, since=None):
     """
     Take date values from end of week, spread non cum values over the week/7
+
+    previous can be the result from the last run and since the first date the weekly data changed. Each day only
+    depends on the week after it so only the days from a week before since get recomputed.
     """
     if "Province" in df.index.names:
         df = df.reset_index("Province")
     df = df[~df.index.duplicated(keep='first')]  # Just in case api returned crap data
-    df = df.reindex(pd.date_range(df.index.min(), df.index.max(), name="Date"))
+    all_days = pd.date_range(df.index.min(), df.index.max(), name="Date")
     cums = [c for c in df.columns if " Cum" in c]
     others = [c for c in df.columns if " Cum" not in c and "Province" != c]
+    start = all_days[0]
+    if previous is not None and since is not None and not previous.empty and previous.index.min() == start \
+            and not set(others) - set(previous.columns):
+        start = max(start, since - pd.Timedelta(days=6))
+    df = df.reindex(all_days[all_days >= start])
     df = (df[others] / 7).combine_first(df)
-    return df[others][::-1].rolling("7d").min()[::-1]
+    daily = df[others][::-1].rolling("7d").min()[::-1]
+    if start == all_days[0]:
+        return daily
+    return pd.concat([previous[others].reindex(all_days[all_days < start]), daily])
 
 
 def daily2cum(results):
@@ -242,6 +490,65 @@ def cut_ages(df, ages=[10, 20, 30, 40, 50, 60, 70], age_col="Age", group_col="Ag
     return df
 
 
+FUZZY_CACHE_DIR = "inputs/fuzzy"
+
+
+@functools.lru_cache(maxsize=20)
+def _fuzzy_index(candidates):
+    "char count matrix of candidates for quick_ratio upper bounds"
+    vocab = {c: i for i, c in enumerate(sorted(set("".join(candidates))))}
+    counts = np.zeros((len(candidates), len(vocab)), dtype=np.int32)
+    for row, cand in enumerate(candidates):
+        for c in cand:
+            counts[row, vocab[c]] += 1
+    lengths = np.array([len(c) for c in candidates])
+    return vocab, counts, lengths
+
+
+def close_matches(words, candidates, cutoff=0.74):
+    """
+    dict of word -> best match in candidates same as difflib.get_close_matches(word, candidates, 1, cutoff) or None.
+
+    Character counts give an upper bound on the ratio for every candidate at once so only a few need the full
+    SequenceMatcher. Results are remembered in FUZZY_CACHE_DIR between runs.
+
+    >>> close_matches(["Bangkock", "Chiangmai", "xyz"], ["Bangkok", "Chiang Mai", "Chiang Rai"])
+    {'Bangkock': 'Bangkok', 'Chiangmai': 'Chiang Rai', 'xyz': None}
+    """
+    candidates = tuple(candidates)
+    fingerprint = hashlib.sha1("\n".join(candidates).encode()).hexdigest()
+    cache_file = os.path.join(FUZZY_CACHE_DIR, f"{fingerprint}-{cutoff}.json")
+    if os.path.exists(cache_file):
+        with open(cache_file) as fp:
+            memo = json.load(fp)
+    else:
+        memo = {}
+    todo = [w for w in dict.fromkeys(words) if w not in memo]
+    if todo and candidates:
+        vocab, counts, lengths = _fuzzy_index(candidates)
+        for word in todo:
+            wcounts = np.zeros(len(vocab), dtype=np.int32)
+            for c in word:
+                if c in vocab:
+                    wcounts[vocab[c]] += 1
+            total = lengths + len(word)
+            # same bound as SequenceMatcher.quick_ratio
+            quick = 2.0 * np.minimum(counts, wcounts).sum(axis=1) / np.maximum(total, 1)
+            best = None
+            for i in np.nonzero(quick >= cutoff)[0]:
+                ratio = difflib.SequenceMatcher(None, candidates[i], word).ratio()
+                # get_close_matches takes the largest (ratio, candidate)
+                if ratio >= cutoff and (best is None or (ratio, candidates[i]) > best):
+                    best = (ratio, candidates[i])
+            memo[word] = best[1] if best else None
+        os.makedirs(FUZZY_CACHE_DIR, exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as fp:
+            json.dump(memo, fp, ensure_ascii=False)
+        os.replace(tmp_file, cache_file)
+    return {w: memo.get(w) for w in words}
+
+
 def fuzzy_join(a,
                b,
                on,
@@ -263,9 +570,11 @@ def fuzzy_join(a,
     if unmatched.empty:
         second = first
     else:
-        a["fuzzy_match"] = unmatched[on].map(
-            lambda x: next(iter(difflib.get_close_matches(trim(x), b.index, 1, cutoff=cutoff)), None),
-            na_action="ignore")
+        # Each distinct value only needs matching once
+        keys = unmatched[on].dropna().unique()
+        trimmed = {k: trim(k) for k in keys}
+        matches = close_matches(list(set(trimmed.values())), b.index, cutoff=cutoff)
+        a["fuzzy_match"] = unmatched[on].map({k: matches[t] for k, t in trimmed.items()}, na_action="ignore")
         second = first.combine_first(a.join(b, on="fuzzy_match"))
         del second["fuzzy_match"]
         unmatched2 = second[second[test].isnull() & second[on].notna()]
@@ -289,7 +598,183 @@ def fuzzy_join(a,
         return second
 
 
-def export(df, name, csv_only=False, dir="api"):
+# Typed binary copy of what read_csv gave us for each imported csv so we don't have to parse the csv again.
+# STORAGE=csv turns it off
+STORE_DIR = "inputs/store"
+STORAGE_BACKENDS = {
+    "parquet": (".parquet", lambda df, path: df.to_parquet(path, index=False), pd.read_parquet),
+    "feather": (".feather", lambda df, path: df.to_feather(path), pd.read_feather),
+}
+STORAGE = os.environ.get("STORAGE", "feather")
+
+
+def store_path(name, dir):
+    "where the binary copy of dir/name.csv is kept. None if STORAGE has no binary backend"
+    if STORAGE not in STORAGE_BACKENDS:
+        return None
+    ext, _, _ = STORAGE_BACKENDS[STORAGE]
+    return os.path.join(STORE_DIR, os.path.normpath(dir).replace(os.sep, "_"), f"{name}{ext}")
+
+
+def csv_key(csv, read_args):
+    "size and mtime of csv and how it was read so we can tell if the binary copy is what read_csv would give now"
+    stat = os.stat(csv)
+    return f"{stat.st_size} {stat.st_mtime_ns} {read_args!r}"
+
+
+def store_save(df, name, dir, read_args):
+    "Save df, what read_csv(dir/name.csv, **read_args) returned, as its binary copy"
+    path = store_path(name, dir)
+    if path is None:
+        return
+    _, write, _ = STORAGE_BACKENDS[STORAGE]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        write(df, tmp)
+    except (pyarrow.ArrowException, ValueError, TypeError) as e:
+        # mixed types in a column. Will just have to use the csv
+        logger.warning("Can't store {} as {}: {}", name, STORAGE, e)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return
+    os.replace(tmp, path)
+    with open(tmp, "w") as fp:
+        fp.write(csv_key(os.path.join(dir, f"{name}.csv"), read_args))
+    os.replace(tmp, f"{path}.key")
+
+
+def store_load(name, dir, read_args):
+    "The binary copy of dir/name.csv if it was made from the csv as it is now with the same read_args, otherwise None"
+    path = store_path(name, dir)
+    if path is None or not os.path.exists(path) or not os.path.exists(f"{path}.key"):
+        return None
+    with open(f"{path}.key") as fp:
+        if fp.read() != csv_key(os.path.join(dir, f"{name}.csv"), read_args):
+            return None
+    _, _, read = STORAGE_BACKENDS[STORAGE]
+    try:
+        df = read(path)
+    except (pyarrow.ArrowException, OSError) as e:
+        logger.warning("Can't read {}: {}", path, e)
+        return None
+    # arrow gives back missing strings as None where read_csv has NaN
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].where(df[col].notna(), np.nan)
+    return df
+
+
+def _json_default(value):
+    "json.dumps default for the numpy and pandas values to_json handles that can be left in object columns"
+    if isinstance(value, (pd.Timestamp, datetime.datetime)):
+        return pd.Timestamp(value).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]  # same as to_json(date_format="iso")
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return round(float(value), 10)
+    if isinstance(value, np.bool_):
+        return bool(value)
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _json_values(df):
+    "df as a 2d array of json ready values plus a mask of the missing ones"
+    values = np.empty(df.shape, dtype=object)
+    missing = np.zeros(df.shape, dtype=bool)
+    floats = [i for i, t in enumerate(df.dtypes) if pd.api.types.is_float_dtype(t)]
+    if floats:
+        # do all the float columns in one go as there can be thousands
+        block = df.iloc[:, floats].to_numpy(dtype=float).round(10)  # same precision as to_json
+        missing[:, floats] = ~np.isfinite(block)
+        values[:, floats] = block
+    for i in set(range(df.shape[1])) - set(floats):
+        col = df.iloc[:, i]
+        if pd.api.types.is_datetime64_any_dtype(col):
+            # same as to_json(date_format="iso")
+            col = col.dt.strftime("%Y-%m-%dT%H:%M:%S.%f").str[:-3]
+        missing[:, i] = col.isna().to_numpy()
+        values[:, i] = col.astype(object).tolist()
+    return values, missing
+
+
+def json_chunks(df, orient="records", chunksize=1000):
+    """
+    Yield the json text for df a row (or column) at a time, leaving out any missing values.
+    Only chunksize rows (or columns) are converted at a time so it doesn't need a copy of the whole frame.
+
+    orient="records" is a list of row objects, orient="columns" is an object of {column: {row: value}}.
+
+    >>> df = pd.DataFrame({"Date": pd.to_datetime(["2021-01-01", "2021-01-02"]), "A": [1.5, None], "B": ["x", None]})
+    >>> print("".join(json_chunks(df)))
+    [
+    {"Date": "2021-01-01T00:00:00.000", "A": 1.5, "B": "x"},
+    {"Date": "2021-01-02T00:00:00.000"}
+    ]
+    >>> print("".join(json_chunks(df, orient="columns")))
+    {
+    "Date": {"0": "2021-01-01T00:00:00.000", "1": "2021-01-02T00:00:00.000"},
+    "A": {"0": 1.5},
+    "B": {"0": "x"}
+    }
+    """
+    names = np.array([str(c) for c in df.columns], dtype=object)
+    if orient == "records":
+        yield "["
+        for start in range(0, len(df), chunksize):
+            values, missing = _json_values(df.iloc[start:start + chunksize])
+            for i in range(len(values)):
+                keep = ~missing[i]
+                record = dict(zip(names[keep], values[i, keep]))
+                yield (",\n" if start + i else "\n") + json.dumps(record, ensure_ascii=False, default=_json_default)
+        yield "\n]"
+    elif orient == "columns":
+        rows = np.array([str(r) for r in range(len(df))], dtype=object)
+        yield "{"
+        for start in range(0, len(names), chunksize):
+            values, missing = _json_values(df.iloc[:, start:start + chunksize])
+            for i, name in enumerate(names[start:start + chunksize]):
+                keep = ~missing[:, i]
+                column = dict(zip(rows[keep], values[keep, i]))
+                yield (",\n" if start + i else "\n") + json.dumps(name) + ": " + \
+                    json.dumps(column, ensure_ascii=False, default=_json_default)
+        yield "\n}"
+    else:
+        raise ValueError(f"Unknown orient {orient}")
+
+
+def export_json(df, path, orient="records", compress=None):
+    """
+    Stream df to path as compact json without nulls. compress="gzip" or "brotli" writes path.gz or path.br instead.
+    brotli needs the brotli package installed.
+    Returns the path written.
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    if compress == "gzip":
+        path = f"{path}.gz"
+        with gzip.open(tmp, "wt", compresslevel=6, encoding="utf8") as fp:
+            fp.writelines(json_chunks(df, orient))
+    elif compress == "brotli":
+        import brotli  # optional
+        path = f"{path}.br"
+        compressor = brotli.Compressor(mode=brotli.MODE_TEXT)
+        with open(tmp, "wb") as fp:
+            for chunk in json_chunks(df, orient):
+                fp.write(compressor.process(chunk.encode("utf8")))
+            fp.write(compressor.finish())
+    elif compress is None:
+        with open(tmp, "w", encoding="utf8") as fp:
+            fp.writelines(json_chunks(df, orient))
+    else:
+        raise ValueError(f"Unknown compression {compress}")
+    os.replace(tmp, path)
+    return path
+
+
+def export(df, name, csv_only=False, dir="api", orient="records", compress=None):
     try:
         df = df.reset_index()
     except:
@@ -298,16 +783,8 @@ def export(df, name, csv_only=False, dir="api"):
     # for c in set(list(df.select_dtypes(include=['datetime64']).columns)):
     #     df[c] = df[c].dt.strftime('%Y-%m-%d')
     os.makedirs(dir, exist_ok=True)
-    # TODO: save space by dropping nan
-    # json.dumps([row.dropna().to_dict() for index,row in df.iterrows()])
     if not csv_only:
-        path = os.path.join(dir, name)
-        df.to_json(
-            path,
-            date_format="iso",
-            indent=3,
-            orient="records",
-        )
+        path = export_json(df, os.path.join(dir, name), orient=orient, compress=compress)
         logger.info("Exporting: {}", path)
     path = os.path.join(dir, f"{name}.csv")
     df.to_csv(
@@ -325,23 +802,228 @@ def import_csv(name, index=None, return_empty=False, date_cols=['Date'], str_col
             return pd.DataFrame(columns=index).set_index(index)
         else:
             return pd.DataFrame()
-    logger.info("Importing CSV: {}", path)
-    # TODO: set dtypes when we know its all floats so works faster?
-    dtypes = {col: "str" for col in str_cols} | {col: "int" for col in int_cols}
-    df = pd.read_csv(path, parse_dates=date_cols, dtype=dtypes)
+    read_args = dict(parse_dates=date_cols, dtype={col: "str" for col in str_cols} | {col: "int" for col in int_cols})
+    df = store_load(name, dir, read_args)
+    if df is not None:
+        logger.info("Importing {}: {}", STORAGE, store_path(name, dir))
+    else:
+        logger.info("Importing CSV: {}", path)
+        df = pd.read_csv(path, **read_args)
+        # so next time it's quick
+        store_save(df, name, dir, read_args)
     if index:
         return df.set_index(index)
     else:
         return df
 
 
+def _partition_keys(df, date_col, partition_cols):
+    "year, week of each row. Rows without a date go in year=0/week=00"
+    if partition_cols:
+        year, week = partition_cols
+        return df[year].fillna(0).astype(int), df[week].fillna(0).astype(int)
+    cal = pd.to_datetime(df[date_col]).dt.isocalendar()
+    return cal['year'].fillna(0).astype(int), cal['week'].fillna(0).astype(int)
+
+
+def export_partitioned(df, name, dir="inputs/json", date_col="Date", partition_cols=None):
+    """
+    Save df as parquet files partitioned by year/week of date_col (or year, week partition_cols) plus a manifest.
+
+    Only partitions whose contents have changed since the last export get written so appending a few days of rows
+    to a large line list is quick.
+    """
+    df = df.reset_index(drop=df.index.names == [None])
+    base = os.path.join(dir, name)
+    os.makedirs(base, exist_ok=True)
+    manifest_path = os.path.join(base, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as fp:
+            manifest = json.load(fp)
+    else:
+        manifest = {}
+    new_manifest = {}
+    written = 0
+    # partitions in year/week order. rows keep their order within each one
+    for (year, week), part in df.groupby(list(_partition_keys(df, date_col, partition_cols)), sort=True):
+        key = f"year={year}/week={week:02}"
+        part = part.reset_index(drop=True)
+        digest = str(pd.util.hash_pandas_object(part, index=False).sum()) + str(list(part.columns))
+        info = dict(file=f"{key}.parquet", rows=len(part), hash=digest)
+        if date_col in part.columns and part[date_col].notna().any():
+            dates = pd.to_datetime(part[date_col])
+            info.update(min=str(dates.min().date()), max=str(dates.max().date()))
+        new_manifest[key] = info
+        if manifest.get(key, {}).get("hash") == digest and os.path.exists(os.path.join(base, info['file'])):
+            continue
+        path = os.path.join(base, info['file'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part.to_parquet(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+        written += 1
+    for key in set(manifest) - set(new_manifest):
+        path = os.path.join(base, manifest[key]['file'])
+        if os.path.exists(path):
+            os.remove(path)
+    with open(manifest_path + ".tmp", "w") as fp:
+        json.dump(new_manifest, fp, indent=1)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    logger.info("Exporting: {} {}/{} partitions changed", base, written, len(new_manifest))
+
+
+def import_partitioned(name, dir="inputs/json", start=None, end=None, date_col="Date"):
+    """
+    Load partitions saved with export_partitioned in year/week order.
+
+    start and end limit it to just the partitions (and rows) needed.
+    """
+    base = os.path.join(dir, name)
+    manifest_path = os.path.join(base, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return pd.DataFrame()
+    with open(manifest_path) as fp:
+        manifest = json.load(fp)
+    start = pd.to_datetime(start) if start is not None else None
+    end = pd.to_datetime(end) if end is not None else None
+    files = []
+    for key, info in manifest.items():
+        if start is not None and "max" in info and pd.to_datetime(info['max']) < start:
+            continue
+        if end is not None and "min" in info and pd.to_datetime(info['min']) > end:
+            continue
+        files.append(os.path.join(base, info['file']))
+    logger.info("Importing: {} {}/{} partitions", base, len(files), len(manifest))
+    if not files:
+        return pd.DataFrame()
+    df = pd.concat([pd.read_parquet(f) for f in files], ignore_index=True)
+    if start is not None:
+        df = df[df[date_col] >= start]
+    if end is not None:
+        df = df[df[date_col] <= end]
+    return df.reset_index(drop=True)
+
+
+FrameHandle = collections.namedtuple("FrameHandle", ["path"])
+
+
+def to_handle(data, dir, compact=False):
+    """
+    Write any DataFrames in data (or in a tuple/list of results) to feather in dir so only the path needs pickling.
+    compact=True stores float64 columns as float32 where that loses nothing so the shared file is smaller.
+    """
+    if isinstance(data, (tuple, list)) and not isinstance(data, FrameHandle):
+        return type(data)(to_handle(item, dir, compact) for item in data)
+    if not isinstance(data, pd.DataFrame):
+        return data
+    if not all(isinstance(c, str) for c in data.columns):
+        # arrow would turn these into str names so send it the slow way
+        return data
+    fd, path = tempfile.mkstemp(suffix=".feather", dir=dir)
+    os.close(fd)
+    try:
+        table = pyarrow.Table.from_pandas(data)
+        if compact:
+            # cast in arrow one column at a time rather than make a float32 copy of the whole frame first
+            for col in float32_lossless(data):
+                i = table.schema.get_field_index(col)
+                table = table.set_column(i, col, table.column(i).cast(pyarrow.float32()))
+        pyarrow.feather.write_feather(table, path, compression="uncompressed")
+    except (pyarrow.ArrowException, ValueError, TypeError) as e:
+        # mixed types. Just send it the slow way
+        logger.warning("Can't share frame as feather, will pickle instead: {}", e)
+        os.remove(path)
+        return data
+    return FrameHandle(path)
+
+
+def from_handle(data, float64=()):
+    """
+    Load any frames written by to_handle. Uncompressed so it's memory mapped rather than read and decoded.
+    Compacted columns starting with any of the float64 prefixes are cast back to float64, the rest stay float32
+    """
+    if isinstance(data, FrameHandle):
+        table = pyarrow.feather.read_table(data.path, memory_map=True)
+        for i, field in enumerate(table.schema):
+            if field.type == pyarrow.float32() and field.name.startswith(tuple(float64)):
+                table = table.set_column(i, field.name, table.column(i).cast(pyarrow.float64()))
+        return table.to_pandas()
+    if isinstance(data, (tuple, list)):
+        return type(data)(from_handle(item, float64) for item in data)
+    return data
+
+
+def float32_lossless(df):
+    "float64 columns of df whose values are all the same as float32"
+    lossless = []
+    for col, dtype in df.dtypes.items():
+        if dtype == np.float64:
+            values = df[col].to_numpy()
+            with np.errstate(over="ignore"):
+                if ((values.astype(np.float32) == values) | np.isnan(values)).all():
+                    lossless.append(col)
+    return lossless
+
+
+def dense(df, cols):
+    "Just cols of df (ignoring missing ones), with any float32 columns from to_handle(compact=True) back as float64"
+    df = df[[c for c in dict.fromkeys(cols) if c in df.columns]]
+    return df.astype({c: np.float64 for c, t in df.dtypes.items() if t == np.float32})
+
+
+def group_rolling(series, level, ma, how="mean"):
+    """
+    Same as series.groupby(level).apply(lambda s: s.rolling(ma, min_periods=int(ma / 2), center=True).mean())
+    (or .apply(trendline) for how="trend") but done for all the groups at once. level=None is a single group.
+
+    >>> s = pd.Series([1.0, 2, 4, 8, 16, 32], index=pd.Index(list("aaabbb"), name="Province"))
+    >>> group_rolling(s, "Province", 3).tolist()
+    [1.5, 2.3333333333333335, 3.0, 12.0, 18.666666666666668, 24.0]
+    >>> group_rolling(s, "Province", 3, "trend").tolist()
+    [0.5, 1.0, 1.0, 4.0, 8.0, 8.0]
+    """
+    if how not in ["mean", "trend"]:
+        raise ValueError(f"Unknown rolling {how}")
+    codes = np.zeros(len(series), dtype=int) if level is None else pd.factorize(series.index.get_level_values(level))[0]
+    order = np.argsort(codes, kind="stable")  # each group together, rows still in their original order
+    codes, values = codes[order], series.to_numpy(dtype=float)[order]
+    pos = np.arange(len(values))
+    group_start, group_end = np.searchsorted(codes, codes, "left"), np.searchsorted(codes, codes, "right")
+    # same window bounds as pandas fixed centered windows, but kept inside each group
+    end = pos + 1 + (ma - 1) // 2
+    start, end = np.maximum(end - ma, group_start), np.minimum(end, group_end)
+    valid = ~np.isnan(values)
+    counts = np.concatenate([[0], np.cumsum(valid)])
+    enough = counts[end] - counts[start] >= int(ma / 2)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if how == "mean":
+            total = np.zeros(len(values))
+            for i in range(ma):
+                idx = np.minimum(start + i, len(values) - 1)
+                total += np.where((start + i < end) & valid[idx], values[idx], 0.0)
+            result = total / (counts[end] - counts[start])
+        else:
+            # trendline() on each window
+            length = end - start
+            mid = np.minimum(start + np.ceil(length / 2).astype(int), len(values) - 1)
+            result = (values[mid] - values[start]) / length
+    result = np.where(enough, result, np.nan)
+    unsorted = np.empty_like(result)
+    unsorted[order] = result
+    return pd.Series(unsorted, index=series.index, name=series.name)
+
+
 def increasing(col, ma=7):
+    """
+    Trend of col per province over a centered ma day window. col can be a func but has to work row by row
+    as it is given rows for all the provinces at once.
+    """
     def increasing_func(adf: pd.DataFrame) -> pd.DataFrame:
         if callable(col):
             series = col(adf)
         else:
             series = adf[col]
-        return series.rolling(ma, min_periods=int(ma / 2), center=True).apply(trendline)
+        return group_rolling(series, "Province" if "Province" in series.index.names else None, ma, "trend")
+    increasing_func.all_provinces = True
     return increasing_func
 
 
@@ -350,6 +1032,7 @@ def decreasing(col, ma=7):
 
     def decreasing_func(adf: pd.DataFrame) -> pd.DataFrame:
         return 1 / inc_func(adf)
+    decreasing_func.all_provinces = True
     return decreasing_func
 
 
@@ -381,8 +1064,11 @@ def topprov(df, metricfunc, valuefunc=None, name="Top 5 Provinces", num=5, other
     # old_index = df.index.names
     valuefunc = metricfunc if valuefunc is None else valuefunc
 
-    # Apply metric on each province by itself
-    with_metric = df.groupby(level="Province", group_keys=False).apply(metricfunc)
+    # Apply metric on each province by itself, unless it can do them all at once
+    if getattr(metricfunc, "all_provinces", False):
+        with_metric = metricfunc(df)
+    else:
+        with_metric = df.groupby(level="Province", group_keys=False).apply(metricfunc)
     with_metric = with_metric.reset_index().set_index("Date")
     metric_col = [c for c in with_metric.columns if c != 'Province']
 
@@ -1,5 +1,8 @@
+import collections
 import concurrent.futures
 import datetime
+import functools
+import hashlib
 import json
 import os
 import pickle
@@ -7,6 +10,7 @@ import random
 import re
 import sys
 import tempfile
+import threading
 import urllib.parse
 from io import StringIO
 from itertools import compress
@@ -20,6 +24,8 @@ import pythainlp
 import requests
 import urllib3
 from bs4 import BeautifulSoup
+from bs4 import Comment
+from bs4 import NavigableString
 from loguru import logger
 from pptx import Presentation
 try:
@@ -66,6 +72,10 @@ urllib3.disable_warnings()
 CHECK_NEWER = bool(os.environ.get("CHECK_NEWER", False))
 USE_CACHE_DATA = os.environ.get('USE_CACHE_DATA', False) == 'True'
 MAX_DAYS = int(os.environ.get("MAX_DAYS", 1 if USE_CACHE_DATA else 0))
+PARSE_LOCAL = os.environ.get('PARSE_LOCAL', False) == 'True'
+PARSE_THREADS = int(os.environ.get("PARSE_THREADS", 4))
+PARSE_CACHE_DIR = "inputs/parsed"
+PARSE_CACHE_MB = int(os.environ.get("PARSE_CACHE_MB", 1000))
 
 NUM_RE = re.compile(r"\d+(?:\,\d+)*(?:\.\d+)?")
 INT_RE = re.compile(r"\d+(?:\,\d+)*")
@@ -107,6 +117,48 @@ def fix_timeouts(s, timeout=None):
 s = requests.Session()
 fix_timeouts(s)
 
+# Max requests in flight per domain (and its subdomains) across all threads in this process.
+# Each process has its own limits so run_dag with a pool of n processes for a lane can make n times as many.
+# ddc.moph.go.th falls over easily
+HOST_LIMITS = {"ddc.moph.go.th": 2}
+DEFAULT_HOST_LIMIT = 5
+_host_sems = {}
+_host_sems_lock = threading.Lock()
+
+
+def host_key(url):
+    """ Domain in HOST_LIMITS that url falls under or else its hostname
+
+    >>> host_key("https://covid19.ddc.moph.go.th/api/Cases")
+    'ddc.moph.go.th'
+    >>> host_key("https://ddc.moph.go.th/viralpneumonia/")
+    'ddc.moph.go.th'
+    >>> host_key("https://notddc.moph.go.th/")
+    'notddc.moph.go.th'
+    """
+    host = urllib.parse.urlparse(url).hostname
+    for domain in HOST_LIMITS:
+        if host == domain or host.endswith(f".{domain}"):
+            return domain
+    return host
+
+
+def host_limit(url):
+    "Semaphore limiting concurrent requests in this process to the domain of url"
+    host = host_key(url)
+    with _host_sems_lock:
+        if host not in _host_sems:
+            _host_sems[host] = threading.BoundedSemaphore(HOST_LIMITS.get(host, DEFAULT_HOST_LIMIT))
+        return _host_sems[host]
+
+
+@functools.lru_cache
+def get_session(timeout, pid):
+    "Shared keep-alive session per timeout. pid so forked workers don't reuse the parent's sockets"
+    session = requests.Session()
+    fix_timeouts(session, timeout)
+    return session
+
 
 # do any tika install now before we start the run and use multiple processes
 config.getParsers()
@@ -135,7 +187,137 @@ logger.add(sys.stderr, format=formatter, enqueue=True)
 ####################
 # Extraction helpers
 #####################
-def parse_file(filename, html=False, paged=True, remove_corrupt=True):
+def prune_parse_cache(max_mb=None):
+    "Remove the least recently used parse_file results until the cache is under max_mb (PARSE_CACHE_MB)"
+    max_bytes = (PARSE_CACHE_MB if max_mb is None else max_mb) * 1024 * 1024
+    files = []
+    for entry in os.scandir(PARSE_CACHE_DIR):
+        if entry.name.endswith(".json"):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue  # another thread pruned it
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # another thread got it first
+        total -= size
+
+
+def file_hash(filename):
+    "sha256 of file contents, read in chunks"
+    sha = hashlib.sha256()
+    with open(filename, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+BLOCK_TAGS = {"p", "div", "li", "tr", "table", "h1", "h2", "h3", "h4", "h5", "h6", "br", "ul", "ol"}
+
+
+def page_text(content):
+    """
+    Text of a page of tika xhtml with a newline after each block, similar to what tika gives for the same html
+
+    >>> print(page_text(BeautifulSoup('<div class="page"><p>Cases 10</p><p>Deaths <b>2</b></p></div>', features="lxml")))
+    Cases 10
+    Deaths 2
+    """
+    def walk(el, text):
+        for child in el.children:
+            if isinstance(child, Comment):
+                continue
+            elif isinstance(child, NavigableString):
+                text.append(str(child))
+            else:
+                walk(child, text)
+                if child.name in BLOCK_TAGS:
+                    text.append("\n")
+        return text
+    text = walk(content, [])
+    return "".join(text).strip()
+
+
+def parse_file(filename, html=False, paged=True, remove_corrupt=True, local=None, cache=True):
+    """
+    Parse file with tika. Results are cached in inputs/parsed by content hash so unchanged files aren't reparsed.
+    The least recently used are removed once the cache is over PARSE_CACHE_MB. cache=False to not cache at all.
+
+    local=True (or PARSE_LOCAL=True) splits and extracts the page text from the xhtml here rather than sending
+    each page back to tika.
+    """
+    local = PARSE_LOCAL if local is None else local
+    os.makedirs(PARSE_CACHE_DIR, exist_ok=True)
+    cache_file = os.path.join(PARSE_CACHE_DIR, f"{file_hash(filename)}.{html}.{paged}{'.local' if local else ''}.json")
+    result = None
+    if cache:
+        try:
+            with open(cache_file) as fp:
+                result = json.load(fp)
+            os.utime(cache_file)  # mtime is when it was last used
+        except FileNotFoundError:
+            pass  # not cached or another thread just pruned it
+    if result is None:
+        result = _parse_file(filename, html=html, paged=paged, remove_corrupt=remove_corrupt, local=local)
+        if result is None:
+            # corrupt. Don't cache so we parse it again once redownloaded
+            return "" if not paged else []
+        if isinstance(result, BeautifulSoup):
+            result = str(result)
+        if cache:
+            # write then rename so a killed run or another thread can't leave half a cache file
+            tmp_file = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_file, "w") as fp:
+                json.dump(result, fp)
+            os.replace(tmp_file, cache_file)
+            prune_parse_cache()
+    if html and not paged:
+        return BeautifulSoup(result, features="lxml")
+    return result
+
+
+def parse_files(items, get_file=lambda item: item, threads=None, **kwargs):
+    """
+    Download and parse files concurrently but yield (item, file, pages) in the same order as items.
+
+    get_file turns each item into a filename (downloading it if needed) or None to skip parsing it.
+    The tika server handles each request on its own thread so this uses more than one core.
+    Only a few items ahead are started so items can be a lazy iterator.
+    kwargs are passed to parse_file.
+    """
+    threads = PARSE_THREADS if threads is None else threads
+
+    def parse(item):
+        file = get_file(item)
+        if file is None:
+            return item, None, None
+        return item, file, parse_file(file, **kwargs)
+
+    if threads <= 1:
+        yield from map(parse, items)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        window = collections.deque()
+        try:
+            for item in items:
+                window.append(executor.submit(parse, item))
+                if len(window) > threads * 2:
+                    yield window.popleft().result()
+            while window:
+                yield window.popleft().result()
+        finally:
+            # caller stopped early. Don't download and parse the ones we started ahead
+            for future in window:
+                future.cancel()
+
+
+def _parse_file(filename, html=False, paged=True, remove_corrupt=True, local=False):
     pages_txt = []
 
     # Read PDF file
@@ -143,7 +325,7 @@ def parse_file(filename, html=False, paged=True, remove_corrupt=True):
     if not data or not data["content"] and remove_corrupt:
         # file is corrupt. Delete is so can get redownloaded
         os.remove(filename)
-        return "" if not paged else []
+        return None
     xhtml_data = BeautifulSoup(data["content"], features="lxml")
     if html and not paged:
         return xhtml_data
@@ -156,6 +338,11 @@ def parse_file(filename, html=False, paged=True, remove_corrupt=True):
 
     # TODO: slides are divided by slide-content and slide-master-content rather than being contained
     for i, content in enumerate(pages):
+        if local:
+            # one tika call per document. Blank pages come back as "" like they do from tika
+            text = page_text(content)
+            pages_txt.append(repr(content) if html and text else text)
+            continue
         # Parse PDF data using TIKA (xml/html)
         # It's faster and safer to create a new buffer than truncating it
         # https://stackoverflow.com/questions/4330812/how-do-i-clear-a-stringio-object
@@ -324,6 +511,85 @@ def resume_from(file, remote_date, check=True, size=0, appending=False):
         return -1
 
 
+META_DIR = "inputs/meta"
+
+
+def url_meta(url):
+    "What we know about the last download of url. etag, last_modified, size, sha256, fetched_at"
+    path = os.path.join(META_DIR, hashlib.sha1(url.encode()).hexdigest() + ".json")
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def save_url_meta(url, file, headers, sent={}):
+    """
+    Record the validators for url so next time we can do a conditional GET instead of HEAD + GET.
+    sent is the meta used for a conditional GET. If we still got the same file back the server ignores them.
+    """
+    os.makedirs(META_DIR, exist_ok=True)
+    path = os.path.join(META_DIR, hashlib.sha1(url.encode()).hexdigest() + ".json")
+    meta = dict(
+        url=url,
+        etag=headers.get("ETag"),
+        last_modified=headers.get("Last-Modified"),
+        size=os.path.getsize(file),
+        sha256=file_hash(file),
+        fetched_at=datetime.datetime.now().astimezone().isoformat(),
+    )
+    if url_meta(url).get("conditional") is False or sent.get("sha256") == meta["sha256"]:
+        meta["conditional"] = False
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as fp:
+        json.dump(meta, fp)
+    os.replace(tmp_path, path)
+
+
+def url_head(session, url, **kwargs):
+    "HEAD url and return (headers, last modified, size) or (None, None, None) if it fails"
+    try:
+        with host_limit(url):
+            r = session.head(url, **kwargs)
+    except (Timeout, RequestException):
+        return None, None, None
+    if r.headers.get("content-range"):
+        pre, size = r.headers.get("content-range").split("/")
+        assert "bytes" in pre
+        return r.headers, r.headers.get("Last-Modified"), int(size)
+    return r.headers, r.headers.get("Last-Modified"), int(r.headers.get("content-length", 0))
+
+
+def conditional_meta(url, file, check):
+    """
+    url_meta if it can be used for a conditional GET of url. i.e. file is still what we downloaded,
+    there are validators to send and the server didn't ignore them last time. Otherwise {}.
+    The sha256 is only compared when check means we will send the GET. A file the same size as we downloaded
+    but with a different sha256 is then removed so it gets downloaded again.
+    """
+    meta = url_meta(url) if os.path.exists(file) else {}
+    if not meta or meta["size"] != os.path.getsize(file) or not (meta["etag"] or meta["last_modified"]):
+        return {}
+    if meta.get("conditional") is False:
+        return {}
+    if check and meta.get("sha256") != file_hash(file):
+        # Not what we downloaded. Delete it so it gets downloaded again
+        logger.warning("Cached file changed since download: {}. Redownloading", file)
+        os.remove(file)
+        return {}
+    return meta
+
+
+def conditional_headers(meta):
+    "request headers for a conditional GET from url_meta"
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    return headers
+
+
 def is_cutshort(file, modified, check):
 
     if type(modified) == str:
@@ -346,31 +612,45 @@ def links_html_namer(url, _):
     return "-".join(url.split("/")[2:]) + ".html"
 
 
-def web_links(*index_urls, ext=".pdf", dir="inputs/html", match=None, filenamer=links_html_namer, check=True, timeout=None, proxy=False, ignore_errors=False):
+def web_links(*index_urls, ext=".pdf", dir="inputs/html", match=None, filenamer=links_html_namer, check=True, timeout=None,
+              proxy=False, ignore_errors=False, threads=5):
     def is_ext(a):
         return len(a.get("href").rsplit(ext)) == 2 if ext else True
 
     def is_match(a):
         return a.get("href") and is_ext(a) and (match.search(a.get_text(strip=True, separator=' ')) if match else True)
 
-    for file, index, index_url in web_files(*index_urls, dir=dir, check=check, filenamer=filenamer, timeout=timeout, proxy=proxy, threads=1):
+    # links are still yielded in the order of index_urls
+    for file, _, index_url in web_files(*index_urls, dir=dir, check=check, filenamer=filenamer, timeout=timeout, proxy=proxy,
+                                        threads=threads, lazy=True):
         if ignore_errors and file is None:
             continue
         assert file is not None, f"Problem accessing {index_url}"
-        soup = parse_file(file, html=True, paged=False)
+        soup = parse_file(file, html=True, paged=False, cache=False)  # index pages change all the time
         links = (urllib.parse.urljoin(index_url, a.get('href')) for a in soup.find_all('a') if is_match(a))
         for link in links:
             yield link
 
 
-def web_files(*urls, dir=os.getcwd(), check=CHECK_NEWER, strip_version=False, appending=False, filenamer=url2filename, timeout=None, proxy=False, threads=5):
-    """if check is None, then always download"""
-    s = requests.Session()
+def web_files(*urls, dir=os.getcwd(), check=CHECK_NEWER, strip_version=False, appending=False, filenamer=url2filename,
+              timeout=None, proxy=False, threads=5, lazy=False):
+    """
+    if check is None, then always download.
+
+    lazy=True yields a function to read the content instead of the content so callers that only need the filename
+    don't hold every file in memory. It needs a dir to keep the files in.
+
+    Connections are reused across calls and requests per domain in each process are limited by HOST_LIMITS.
+    """
     if timeout is None:
         timeout = 10
         # We only want retries under normal conditions
-    fix_timeouts(s, timeout)
+    s = get_session(timeout, os.getpid())
+    # temp downloads have nowhere to keep meta for
+    keep_meta = dir is not None
     if dir is None:
+        if lazy:
+            raise ValueError("web_files(lazy=True) needs a dir to keep the files in")
         dir = tempfile.gettempdir()
     os.makedirs(dir, exist_ok=True)
 
@@ -384,76 +664,84 @@ def web_files(*urls, dir=os.getcwd(), check=CHECK_NEWER, strip_version=False, ap
         verify = True
 
         remove = False
-        if check or MAX_DAYS:
+        # files that get appended to do a HEAD so we can resume from where we got to
+        meta = conditional_meta(url, target, check) if keep_meta and not appending else {}
+        head = None
+        if meta:
+            # no need for a HEAD. We can send a conditional GET below
+            modified = meta.get("last_modified")
+        # Nothing to compare a HEAD to if we don't have it yet
+        elif (check or MAX_DAYS) and os.path.exists(target):
             proxies = next(proxies_itor, None) if proxy else None
-            try:
-                r = s.head(url, timeout=timeout, verify=verify, proxies=proxies)
-                modified = r.headers.get("Last-Modified")
-                if r.headers.get("content-range"):
-                    pre, size = r.headers.get("content-range").split("/")
-                    size = int(size)
-                    assert "bytes" in pre
-                else:
-                    size = int(r.headers.get("content-length", 0))
-                resumable = r.headers.get('accept-ranges') == 'bytes' and check and size > 0
-            except (Timeout, RequestException):
-                modified = None
+            head, modified, size = url_head(s, url, timeout=timeout, verify=verify, proxies=proxies)
+            resumable = head is not None and head.get('accept-ranges') == 'bytes' and check and size > 0
         else:
             modified = None
         if i > 0 and is_cutshort(target, modified, check):
             return None, None, url
         err = ""
-        if (resume_byte_pos := resume_from(target, modified, check, size, appending)) < 0:
-            if check:
-                # logger.info("Unmodified: {}: using cache. {} {}", file, modified, size)
-                pass
+        if meta:
+            resume_byte_pos = 0 if check else -1
+        else:
+            resume_byte_pos = resume_from(target, modified, check, size, appending)
+        if resume_byte_pos < 0:
+            if keep_meta and check and head is not None and os.path.exists(target):
+                # Unmodified so these validators apply to what we have. Next time can skip the HEAD
+                save_url_meta(url, target, head)
         else:
             # go back 10% in case end of data changed (e.g csv)
             resume_byte_pos = int(resume_byte_pos * 0.95) if resumable else 0
-            resume_header = {'Range': f'bytes={resume_byte_pos}-'} if resumable else {}
+            resume_header = {'Range': f'bytes={resume_byte_pos}-'} if resumable else conditional_headers(meta)
+            head = None  # only keep validators from a successful download
 
             if resume_byte_pos > 0:
                 target = file
 
-            proxies = next(proxies_itor, None) if proxy else None
-            try:
-                # handle resuming based on range requests - https://stackoverflow.com/questions/22894211/how-to-resume-file-download-in-python
-                # Speed up covid-19 download a lot, but might have to jump back to make sure we don't miss data.
-                r = s.get(url, timeout=timeout, stream=True, headers=resume_header, allow_redirects=True,
-                          verify=verify, proxies=proxies)
-            except (Timeout, RequestException) as e:
-                err = str(e)
-                r = None
-            #if type(check) == int and check > 0:
-            #    check -= 1  # HACK: using int as Boolean above
-            if r is None or r.status_code >= 300:
-                err = f"bad response {r.status_code}, {r.content}" if r is not None else err
-                if not os.path.exists(file):
-                    logger.info("Error downloading: {}: skipping. {}", url, err)
-                    return None, None, url
-                logger.info("Error downloading: {}: using cache {} {}", url, file, err)
-            else:
-                logger.bind(end="").opt(raw=True).info("Download: {} {} {}", file, url, modified)
-                os.makedirs(os.path.dirname(file), exist_ok=True)
-                mode = "w+b" if resume_byte_pos > 0 else "wb"
-                with open(file, mode) as f:
-                    f.seek(resume_byte_pos, 0)
-                    # TODO: handle timeouts happening below since now switched to streaming
-                    try:
-                        for chunk in r.iter_content(chunk_size=2 * 1024 * 1024):
-                            if chunk:  # filter out keep-alive new chunks
-                                f.write(chunk)
-                                logger.bind(end="").opt(raw=True).info(".")
-                    except (Timeout, RequestException) as e:
-                        if resumable:
-                            # TODO: should we revert to last version instead?
-                            logger.opt(raw=True).info("Error downloading: {}: resumable file incomplete {}", file, str(e))
-                            return None, None, url
-                        else:
-                            logger.opt(raw=True).info("Error downloading: {}: skipping. {}", file, str(e))
-                            remove = True
-                logger.opt(raw=True).info("\n")
-            logger.bind(end="\n")
+            with host_limit(url):  # held while streaming the body too
+                proxies = next(proxies_itor, None) if proxy else None
+                try:
+                    # handle resuming based on range requests
+                    # https://stackoverflow.com/questions/22894211/how-to-resume-file-download-in-python
+                    # Speed up covid-19 download a lot, but might have to jump back to make sure we don't miss data.
+                    r = s.get(url, timeout=timeout, stream=True, headers=resume_header, allow_redirects=True,
+                              verify=verify, proxies=proxies)
+                except (Timeout, RequestException) as e:
+                    err = str(e)
+                    r = None
+                #if type(check) == int and check > 0:
+                #    check -= 1  # HACK: using int as Boolean above
+                if r is not None and r.status_code == 304:
+                    logger.info("Cached Unmodified (304): {} {}", modified, target)
+                    file = target
+                elif r is None or r.status_code >= 300:
+                    err = f"bad response {r.status_code}, {r.content}" if r is not None else err
+                    if not os.path.exists(file):
+                        logger.info("Error downloading: {}: skipping. {}", url, err)
+                        return None, None, url
+                    logger.info("Error downloading: {}: using cache {} {}", url, file, err)
+                else:
+                    logger.bind(end="").opt(raw=True).info("Download: {} {} {}", file, url, modified)
+                    os.makedirs(os.path.dirname(file), exist_ok=True)
+                    mode = "w+b" if resume_byte_pos > 0 else "wb"
+                    with open(file, mode) as f:
+                        f.seek(resume_byte_pos, 0)
+                        # TODO: handle timeouts happening below since now switched to streaming
+                        try:
+                            for chunk in r.iter_content(chunk_size=2 * 1024 * 1024):
+                                if chunk:  # filter out keep-alive new chunks
+                                    f.write(chunk)
+                                    logger.bind(end="").opt(raw=True).info(".")
+                        except (Timeout, RequestException) as e:
+                            if resumable:
+                                # TODO: should we revert to last version instead?
+                                logger.opt(raw=True).info("Error downloading: {}: resumable file incomplete {}", file, str(e))
+                                return None, None, url
+                            else:
+                                logger.opt(raw=True).info("Error downloading: {}: skipping. {}", file, str(e))
+                                remove = True
+                    logger.opt(raw=True).info("\n")
+                    head = r.headers if not remove else None
+                logger.bind(end="\n")
         if remove:
             os.remove(file)  # if we leave it without check it will never get fixed
             # return None, None, url
@@ -461,11 +749,15 @@ def web_files(*urls, dir=os.getcwd(), check=CHECK_NEWER, strip_version=False, ap
             if not remove and os.path.exists(file):
                 os.rename(file, target)
             file = target
-        if os.path.exists(file):
+        if keep_meta and resume_byte_pos >= 0 and head is not None and os.path.exists(file):
+            save_url_meta(url, file, head, meta)
+        if not os.path.exists(file):
+            return None, None, url
+        elif lazy:
+            content = Path(file).read_bytes
+        else:
             with open(file, "rb") as f:
                 content = f.read()
-        else:
-            return None, None, url
         if dir is None:
             os.remove(file)
         # i += 1
@@ -1,6 +1,11 @@
+import concurrent.futures
 import datetime
-import itertools
+import functools
 import json
+import math
+import os
+import queue
+import threading
 import time
 from json.decoder import JSONDecodeError
 
@@ -9,11 +14,15 @@ import numpy as np
 import pandas as pd
 import requests
 import tableauscraper
+from bs4 import BeautifulSoup
 
 from utils_scraping import any_in
 from utils_scraping import fix_timeouts
 from utils_scraping import logger
 
+# Tableau sessions workbook_iterate uses at once. Each one is a separate server session
+TABLEAU_SESSIONS = int(os.environ.get("TABLEAU_SESSIONS", 1))
+
 
 ###########################
 # Tableau scraping
@@ -72,6 +81,37 @@ def workbook_value(wb, date, name, col, default=0.0, is_date=False):
     return res
 
 
+def workbook_values(wb, date, mappings, defaults={"": 0.0}):
+    """
+    Single values from many worksheets as one row indexed by date.
+    Same as combining workbook_value for each column but the worksheets are looked up by name once and it
+    builds one row rather than combining a frame per column. Each worksheet still has its first value
+    turned into a number on its own.
+
+    mappings is column=worksheet name or a list of names where the first one present is used.
+    Empty or missing worksheets get defaults[column] (or defaults[""]) or are left out if that is None.
+    """
+    try:
+        sheets = {ws.name: ws for ws in wb.worksheets}
+    except (TypeError, AttributeError):
+        logger.info("Error getting tableau {} {}", list(mappings.keys()), date)
+        return pd.DataFrame()
+    values = {}
+    for col, names in mappings.items():
+        names = [names] if isinstance(names, str) else names
+        ws = next((sheets[name] for name in names if name in sheets), None)
+        if ws is None or ws.data.empty:
+            default = defaults.get(col, defaults.get(""))
+            if default is not None:
+                values[col] = default
+            continue
+        try:
+            values[col] = pd.to_numeric(ws.data.loc[0]).iloc[0]  # HACK: shouldn't assume we want numbers
+        except ValueError:
+            values[col] = pd.to_numeric(ws.data.loc[0].str.replace(",", "").replace("%null%", "")).iloc[0]
+    return pd.DataFrame(values, index=pd.DatetimeIndex([date], name="Date").normalize())
+
+
 def workbook_series(wb, name, mappings, defaults={"": 0.0}, index_col="Date", end=None, index_date=True, index_value=None):
     name = name if type(name) == str else next((n for n in name if n in [s.name for s in wb.worksheets]), None)
     if name is None:
@@ -238,8 +278,51 @@ def workbook_flatten(wb, date=None, defaults={"": 0.0}, **mappings):
     return res
 
 
-def workbook_iterate(url, verify=True, inc_no_param=False, max_errors=20, **selects):
-    "generates combinations of workbooks from combinations of parameters, selects or filters"
+def gray_product(*values):
+    """
+    Like itertools.product but every other pass of an inner list goes backwards so consecutive
+    combinations differ by only one value. i.e. only one param, select or filter changes per step.
+
+    >>> gray_product("ab", [1, 2, 3])
+    [('a', 1), ('a', 2), ('a', 3), ('b', 3), ('b', 2), ('b', 1)]
+    >>> gray_product("ab", "xy", [1, 2])
+    [('a', 'x', 1), ('a', 'x', 2), ('a', 'y', 2), ('a', 'y', 1), ('b', 'y', 1), ('b', 'y', 2), ('b', 'x', 2), ('b', 'x', 1)]
+    """
+    combinations = [()]
+    for vals in values:
+        vals = list(vals)
+        combinations = [c + (v,) for i, c in enumerate(combinations) for v in (vals if i % 2 == 0 else vals[::-1])]
+    return combinations
+
+
+def tableau_config(url, verify=True, session=None):
+    "The config json in a viz page which has the sessionid and workbookLastPublishedAt. {} if there isn't one"
+    if session is None:
+        session = requests.Session()
+        fix_timeouts(session, timeout=30)
+    r = session.get(url, params={":embed": "y", ":showVizHome": "no"}, verify=verify)
+    config = BeautifulSoup(r.text, "html.parser").find("textarea", {"id": "tsConfigContainer"})
+    return json.loads(config.text) if config is not None else {}
+
+
+def tableau_published(url, verify=True):
+    "When the workbook at url was last published. Only fetches the page so much cheaper than loading it"
+    time_str = tableau_config(url, verify=verify).get("workbookLastPublishedAt")
+    return None if time_str is None else dateutil.parser.isoparse(time_str)
+
+
+def workbook_iterate(url, verify=True, inc_no_param=False, max_errors=20, sessions=None, ordered=True, skip=None, checks=(),
+                     **selects):
+    """
+    generates combinations of workbooks from combinations of parameters, selects or filters
+
+    Combinations are in gray_product order so each step changes as few params as possible.
+    skip(next_idx) returning True leaves that combination out before any requests are made for it.
+    sessions>1 (or TABLEAU_SESSIONS) fetches combinations on that many tableau sessions at once. Each session
+    resets and counts max_errors on its own. ordered=False yields them as they complete.
+    checks are worksheet names every combination needs. They get retried with a reset if missing, same as
+    get_workbook(*checks), but also work when fetched ahead on a pool of sessions.
+    """
 
     def do_reset():
         for _ in range(2):
@@ -317,16 +400,24 @@ def workbook_iterate(url, verify=True, inc_no_param=False, max_errors=20, **sele
     if inc_no_param:
         yield lambda: wb, None
 
-    last_idx = [None] * len(selects)  # Outside so we know if we need to change teh params or not
     # Get all combinations of the values of params, select or filter
-    combinations = list(itertools.product(*product_values.values()))
+    combinations = gray_product(*product_values.values())
     assert len(combinations) > 0
-    logger.info(f"MOPH Dashboard: iteration combinations {len(combinations)} at {url}")
-    for next_idx in combinations:
-        def get_workbook(*checks, wb=wb, next_idx=next_idx):
-            nonlocal last_idx, max_errors
-            reset = False
-            if max_errors <= 0:
+    todo = [next_idx for next_idx in combinations if skip is None or not skip(next_idx)]
+    logger.info(f"MOPH Dashboard: iteration combinations {len(todo)} of {len(combinations)} at {url}")
+    combinations = todo
+    if not combinations:
+        return
+
+    def session(wb):
+        "returns get_workbook(next_idx, *checks) that sets params on its own tableau session. wb=None to load it on first use"
+        last_idx = [None] * len(selects)  # Outside so we know if we need to change teh params or not
+        errors = max_errors
+
+        def get_workbook(next_idx, *checks):
+            nonlocal wb, last_idx, errors
+            reset = wb is None
+            if errors <= 0:
                 logger.warning("MOPH Dashboard Skip {}: Finish iteration due to excess errors", next_idx)
                 return None
             for _ in range(2):
@@ -335,29 +426,129 @@ def workbook_iterate(url, verify=True, inc_no_param=False, max_errors=20, **sele
                     if wb is None:
                         continue
                     reset = False
+                cur = wb
                 for do_set, last_value, value in zip(set_value, last_idx, next_idx):
                     if last_value != value and value is not None:
                         # None means to skip setting this value. #TODO: but does it make sense unless it's just reset?
                         try:
-                            wb = do_set(wb, value)
+                            cur = do_set(cur, value)
                         except Exception as err:
                             logger.info("{} MOPH Dashboard Retry: {}={} Error: {}", next_idx, do_set.__name__, value, err)
                             reset = True
                             break
-                    if not wb.worksheets or len(checks) > 0 and not any_in([ws.name for ws in wb.worksheets], *checks):
+                    if not cur.worksheets or len(checks) > 0 and not any_in([ws.name for ws in cur.worksheets], *checks):
                         logger.info("{} MOPH Dashboard Retry: Missing worksheets in {}={}.", next_idx, do_set.__name__, value)
                         reset = True
                         break
                 if reset:
                     last_idx = (None,) * len(last_idx)  # need to reset filters etc
-                    max_errors -= 1
+                    errors -= 1
                     continue
                 last_idx = next_idx
-                return wb
+                return cur
                 # Try again
             logger.warning("MOPH Dashboard Skip: {}. Retries exceeded", next_idx)
             return None
-        yield get_workbook, next_idx
+        return get_workbook
+
+    sessions = min(TABLEAU_SESSIONS if sessions is None else sessions, len(combinations))
+    if sessions <= 1:
+        get_workbook = session(wb)
+        for next_idx in combinations:
+            yield functools.partial(get_workbook, next_idx, *checks), next_idx
+        return
+    yield from _iterate_pool([session(wb)] + [session(None) for _ in range(sessions - 1)], combinations, ordered, checks)
+
+
+def _iterate_pool(sessions, combinations, ordered=True, checks=(), chunk=None):
+    """
+    Fetch combinations on several tableau sessions at once. Each session takes the next contiguous chunk of
+    combinations so within it only one param changes per step, same as a single session.
+    Each fetch is done with checks so the session can reset and retry itself if worksheets are missing.
+    yields (get_workbook, next_idx) in combination order or as they complete if ordered=False.
+    When ordered no session gets more than a chunk per session ahead of what has been yielded.
+    """
+    if chunk is None:
+        chunk = max(1, math.ceil(len(combinations) / (len(sessions) * 4)))
+    ahead = chunk * len(sessions)
+    results = queue.Queue(maxsize=len(sessions) * 2)  # don't get too far ahead of the consumer
+    stop = threading.Event()
+    done = threading.Condition()
+    chunks = iter(range(0, len(combinations), chunk))
+    next_pos = 0
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                return results.put(item, timeout=1)
+            except queue.Full:
+                continue
+
+    def wait_turn(pos):
+        "block until pos is close enough to what was last yielded so pending stays small"
+        with done:
+            while ordered and pos >= next_pos + ahead and not stop.is_set():
+                done.wait(timeout=1)
+
+    def work(get_workbook):
+        try:
+            while not stop.is_set():
+                with done:
+                    start = next(chunks, None)
+                if start is None:
+                    return
+                for pos in range(start, min(start + chunk, len(combinations))):
+                    wait_turn(pos)
+                    if stop.is_set():
+                        return
+                    next_idx = combinations[pos]
+                    try:
+                        wb = get_workbook(next_idx, *checks)
+                    except Exception as err:
+                        # still put something so ordered results don't wait for it
+                        logger.warning("{} MOPH Dashboard Error: {}", next_idx, err)
+                        wb = None
+                    put((pos, next_idx, wb))
+        finally:
+            put(None)
+
+    def fetched(wb, next_idx):
+        def get_workbook(*more_checks):
+            if wb is not None and len(more_checks) > 0 and not any_in([ws.name for ws in wb.worksheets], *more_checks):
+                logger.info("{} MOPH Dashboard Skip: Missing worksheets {}", next_idx, more_checks)
+                return None
+            return wb
+        return get_workbook
+
+    pending = {}
+    running = len(sessions)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(sessions)) as executor:
+        for get_workbook in sessions:
+            executor.submit(work, get_workbook)
+        try:
+            while running:
+                item = results.get()
+                if item is None:
+                    running -= 1
+                    continue
+                pos, next_idx, wb = item
+                if not ordered:
+                    yield fetched(wb, next_idx), next_idx
+                    continue
+                pending[pos] = item
+                while next_pos in pending:
+                    _, next_idx, wb = pending.pop(next_pos)
+                    yield fetched(wb, next_idx), next_idx
+                    with done:
+                        next_pos += 1
+                        done.notify_all()
+            for pos in sorted(pending):
+                _, next_idx, wb = pending[pos]
+                yield fetched(wb, next_idx), next_idx
+        finally:
+            stop.set()
+            with done:
+                done.notify_all()
 
 
 def force_setParameter(wb, parameterName, value):
@@ -1,9 +1,12 @@
+import csv
 import datetime
 import difflib
 import functools
+import io
 import json
 import math
 import os
+import pickle
 import re
 
 import numpy as np
@@ -13,12 +16,15 @@ from dateutil.parser import parse as d
 
 from utils_pandas import export
 from utils_pandas import fuzzy_join
+from utils_pandas import group_rolling
 from utils_pandas import import_csv
 from utils_pandas import rearrange
 from utils_pandas import sensible_precision
+from utils_scraping import file_hash
 from utils_scraping import logger
 from utils_scraping import remove_prefix
 from utils_scraping import remove_suffix
+from utils_scraping import url2filename
 from utils_scraping import web_files
 
 
@@ -34,7 +40,10 @@ REG_LEG = ["Bangkok Region", "Central", "Eastern", "Western", "Northeastern", "N
 REG_COLOURS = "Set2"
 
 
-prov_guesses = pd.DataFrame(columns=["Province", "ProvinceEn", "count"])
+PROVINCE_ALIASES = "inputs/json/province_aliases.csv"
+# (Province, ProvinceEn, count) rows appended by every process as guesses are used. Summed by save_aliases
+PROVINCE_ALIASES_RUN = "inputs/json/province_aliases_run.csv"
+_aliases = None  # Province -> ProvinceEn of past guesses. loaded on first use
 
 
 ###############
@@ -351,8 +360,50 @@ def thaipop2(num: float, pos: int) -> str:
     return '0%' if num == '0' else f'{pp}% {num}M'
 
 
+SUBDISTRICTS_URL = "https://raw.githubusercontent.com/codesanook/thailand-administrative-division-province-district-subdistrict-sql/master/source-data.csv"  # noqa
+PROVINCES_INDEX = "inputs/json/provinces_index.pickle"
+
+
+def province_sources():
+    "files get_provinces is built from and their hashes so we know when to rebuild"
+    files = ["province_mapping.csv", "provinces_regions.csv", os.path.join("inputs/json", url2filename(SUBDISTRICTS_URL))]
+    return [(f, file_hash(f) if os.path.exists(f) else None) for f in files]
+
+
 @functools.lru_cache(maxsize=100, typed=False)
 def get_provinces():
+    """
+    DataFrame of alt name -> ProvinceEn, Health District Number, region, Population etc.
+
+    Built once and saved to PROVINCES_INDEX until any of the source files or the pandas version change.
+    Call before forking worker processes so they share it.
+    """
+    sources = (pd.__version__, province_sources())
+    if os.path.exists(PROVINCES_INDEX):
+        try:
+            with open(PROVINCES_INDEX, "rb") as fp:
+                saved, provinces = pickle.load(fp)
+            if saved == sources:
+                return provinces
+        except Exception as err:
+            # truncated or from an incompatible version. Just rebuild it
+            logger.warning("Rebuilding {}: {}", PROVINCES_INDEX, err)
+    provinces = build_provinces()
+    os.makedirs(os.path.dirname(PROVINCES_INDEX), exist_ok=True)
+    with open(PROVINCES_INDEX + ".tmp", "wb") as fp:
+        pickle.dump((sources, provinces), fp)
+    os.replace(PROVINCES_INDEX + ".tmp", PROVINCES_INDEX)
+    return provinces
+
+
+@functools.lru_cache(maxsize=None)
+def province_lookup():
+    "dict of alt name -> ProvinceEn"
+    names = get_provinces()['ProvinceEn']
+    return names[~names.index.duplicated()].to_dict()
+
+
+def build_provinces():
     def __get_alt_name_mappings(df):
         """ Return dict of alternative name lookup keys for provinces from the Complete Provinces + Alt Names
             dataframe/ dataset.
@@ -396,8 +447,7 @@ def get_provinces():
 
 
 def prov_mapping_subdistricts(provinces):
-    url = "https://raw.githubusercontent.com/codesanook/thailand-administrative-division-province-district-subdistrict-sql/master/source-data.csv"  # noqa
-    file, _, _ = next(web_files(url, dir="inputs/json", check=False))
+    file, _, _ = next(web_files(SUBDISTRICTS_URL, dir="inputs/json", check=False, lazy=True))
     subs = pd.read_csv(file)
     subs = subs.groupby(['AMPHOE_T', 'CHANGWAT_T']).count().reset_index()
     subs['AMPHOE_T'] = subs['AMPHOE_T'].str.replace(r"^อ. ", "", regex=True)
@@ -477,7 +527,7 @@ def prov_regions_wealth():
 
     # TODO: seems to have problems now from github actions?
     url = "https://en.wikipedia.org/wiki/List_of_Thai_provinces_by_GPP"
-    file, _, _ = next(web_files(url, dir="inputs/html", check=False), None)
+    file, _, _ = next(web_files(url, dir="inputs/html", check=False, lazy=True), None)
     df = pd.read_html(file)[0]
 
     df.columns = [clean_column_name(x) for x in df.columns]
@@ -520,9 +570,12 @@ def get_province(prov, ignore_error=False, cutoff=0.74, split=False):
     prov = remove_prefix(prov.strip().strip(".").replace(" ", ""), "จ.")
     provinces = get_provinces()
     try:
-        match = provinces.loc[prov]['ProvinceEn']
+        match = province_lookup()[prov]
         return match if not split else [match]
     except KeyError:
+        if (known := province_aliases().get(prov)) is not None:
+            count_alias(prov, known)
+            return known if not split else [known]
         try:
             close = difflib.get_close_matches(prov, provinces.index, 1, cutoff=cutoff)[0]
         except IndexError:
@@ -549,17 +602,70 @@ def get_province(prov, ignore_error=False, cutoff=0.74, split=False):
                 return None
             else:
                 raise KeyError(f"Province {prov} can't be guessed")
-        proven = provinces.loc[close]['ProvinceEn']  # get english name here so we know we got it
-        prov_guesses.loc[(prov_guesses.last_valid_index() or 0) + 1] = dict(Province=prov, ProvinceEn=proven, count=1)
+        proven = province_lookup()[close]  # get english name here so we know we got it
+        add_alias(prov, proven)
         return proven if not split else [proven]
 
 
+def province_aliases():
+    "dict of fuzzy guesses made in this or previous runs"
+    global _aliases
+    if _aliases is None:
+        _aliases = {prov: proven for prov, proven, _ in read_alias_rows(PROVINCE_ALIASES, PROVINCE_ALIASES_RUN)}
+    return _aliases
+
+
+def read_alias_rows(*files):
+    "(Province, ProvinceEn, count) rows of the alias files that exist"
+    for file in files:
+        if os.path.exists(file):
+            with open(file, newline="") as fp:
+                for prov, proven, count in csv.reader(fp):
+                    yield prov, proven, int(count)
+
+
+def count_alias(prov, proven, count=1):
+    """
+    Count a guess for this run. A single appended line so Pool workers can all add to the run file at once and
+    their counts aren't lost when they exit. Summed into PROVINCE_ALIASES by save_aliases
+    """
+    line = io.StringIO()
+    csv.writer(line).writerow([prov, proven, int(count)])
+    os.makedirs(os.path.dirname(PROVINCE_ALIASES_RUN), exist_ok=True)
+    fd = os.open(PROVINCE_ALIASES_RUN, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.getvalue().encode())
+    finally:
+        os.close(fd)
+
+
+def add_alias(prov, proven, count=1):
+    "Record a guess"
+    province_aliases()[prov] = proven
+    count_alias(prov, proven, count)
+
+
+def save_aliases():
+    "Rewrite the alias file once per run with one line per alias and the counts from this run added"
+    counts = {}
+    for prov, proven, count in read_alias_rows(PROVINCE_ALIASES, PROVINCE_ALIASES_RUN):
+        counts[(prov, proven)] = counts.get((prov, proven), 0) + count
+    if not counts:
+        return
+    os.makedirs(os.path.dirname(PROVINCE_ALIASES), exist_ok=True)
+    tmp = f"{PROVINCE_ALIASES}.{os.getpid()}.tmp"
+    with open(tmp, "w", newline="") as fp:
+        csv.writer(fp).writerows([prov, proven, count] for (prov, proven), count in counts.items())
+    os.replace(tmp, PROVINCE_ALIASES)
+    if os.path.exists(PROVINCE_ALIASES_RUN):
+        os.remove(PROVINCE_ALIASES_RUN)
+
+
 def prov_trim(p):
     return remove_suffix(remove_prefix(p, "จ.", "จังหวัด").strip(' .'), " Province").strip()
 
 
 def join_provinces(df, on, extra=["Health District Number"], provinces=None):
-    global prov_guesses
     if provinces is None:
         provinces = get_provinces()
     joined, guess = fuzzy_join(
@@ -571,17 +677,19 @@ def join_provinces(df, on, extra=["Health District Number"], provinces=None):
         "ProvinceEn",
         return_unmatched=True)
     if not guess.empty:
-        prov_guesses = guess.reset_index().rename(columns={on: "Province"})[['Province', 'ProvinceEn', 'count']]
-        for i, row in prov_guesses.iterrows():
-            prov_guesses.loc[(prov_guesses.last_valid_index() or 0) + 1] = row
+        # one row per row that matched the guess so drop the repeats
+        guess = guess.drop_duplicates(subset=[on])
+        for prov, proven, count in guess[[on, 'ProvinceEn', 'count']].dropna().itertuples(index=False):
+            add_alias(prov, proven, count)
 
     return joined
 
 
 def get_fuzzy_provinces():
-    "return dataframe of all the fuzzy matched province names"
-    if not prov_guesses.empty:
-        return prov_guesses.groupby(["Province", "ProvinceEn"]).sum().sort_values("count", ascending=False)
+    "return dataframe of the fuzzy matched province names used in this run"
+    if os.path.exists(PROVINCE_ALIASES_RUN):
+        guesses = pd.DataFrame(read_alias_rows(PROVINCE_ALIASES_RUN), columns=["Province", "ProvinceEn", "count"])
+        return guesses.groupby(["Province", "ProvinceEn"]).sum().sort_values("count", ascending=False)
     else:
         return pd.DataFrame(columns=["Province", "ProvinceEn", "count"])
 
@@ -620,8 +728,10 @@ def trend_table(table_provinces, sensitivity=25, style="green_up", ma_days=7):
     """
     # 14day MA just for cases
     #ma = table_provinces[['Cases','region']]
-    ma = table_provinces.groupby("Province", group_keys=False).apply(lambda df: df.rolling(
-        ma_days, min_periods=int(ma_days / 2), center=True).mean())
+    # group_rolling takes each province's rows in the order they come so put them in date order. Date first also
+    # makes last_valid_index below the latest day
+    table_provinces = table_provinces.sort_index(level=["Date", "Province"])
+    ma = group_rolling(table_provinces, "Province", ma_days)
     # Too sensitive to changes
     # trend = table_provinces.groupby("Province", group_keys=False).apply(increasing(lambda df: df, 3)).to_frame("Trend")
 
@@ -632,16 +742,14 @@ def trend_table(table_provinces, sensitivity=25, style="green_up", ma_days=7):
     if "abs" in style:
         trend = ma * sensitivity
     elif "rank" in style:
-        rank = ma.groupby("Date", group_keys=False).apply(lambda df: df.rank())
+        rank = ma.groupby("Date").rank()
         peak = rank.max().max()
-        trend = rank.groupby("Province", group_keys=False).apply(lambda df: (
-            df - df.shift(int(math.ceil(ma_days / 2)))) / peak * sensitivity)
+        trend = (rank - rank.groupby("Province").shift(int(math.ceil(ma_days / 2)))) / peak * sensitivity
     else:
         ma_pop = ma.to_frame("Value").join(get_provinces()['Population'], on='Province')
         peak = ma.max().max() / ma_pop['Population'].max().max()
-        trend = ma_pop.groupby("Province", group_keys=False).apply(
-            lambda df: ((df['Value'] - df['Value'].shift(int(ma_days / 2))) / df['Population'])
-        ) / peak * sensitivity
+        change = ma_pop['Value'] - ma_pop['Value'].groupby("Province").shift(int(ma_days / 2))
+        trend = change / ma_pop['Population'] / peak * sensitivity
 
     trend = trend[~trend.index.duplicated()]  # TODO: not sure why increasing puts duplicates in?
     ma = ma.to_frame("MA").assign(